@@ -0,0 +1,251 @@
+import numpy as np
+import json
+import os
+import shutil
+import warnings
+from astropy.io import fits
+import astropy.wcs as wcs
+
+
+class CubeAccumulator(object):
+    """
+    Numerator and weight accumulators for a gridded cube, together
+    with the list of input files that have already been added.
+
+    The gridded cube is numerator / weights, so the accumulators can be
+    saved to a checkpoint directory and reloaded later to continue
+    gridding without redoing files that are already included.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the output cube (naxis3, naxis2, naxis1)
+
+    dtype : numpy.dtype
+        Data type of the accumulators.
+
+    header : str
+        WCS header string describing the grid.  Used to check that a
+        reloaded checkpoint matches the requested grid.
+
+    numeratorFile : str
+        If given, the numerator is kept in a memory-mapped .npy file of
+        this name instead of in memory.
+
+    coverage : bool
+        Also keep the (3, naxis2, naxis1) coverage sums filled by
+        `accumulateCoverage`.
+    """
+
+    numeratorName = 'numerator.npy'
+    weightsName = 'weights.npy'
+    coverageName = 'coverage.npy'
+    stateName = 'state.json'
+
+    def __init__(self, shape, dtype=np.float64, header='',
+                 numeratorFile=None, coverage=False):
+        shape = tuple(int(n) for n in shape)
+        self.numeratorFile = numeratorFile
+        if numeratorFile is None:
+            self.numerator = np.zeros(shape, dtype=dtype)
+        else:
+            # A new file is zero filled without touching memory
+            self.numerator = np.lib.format.open_memmap(numeratorFile,
+                                                       mode='w+',
+                                                       dtype=dtype,
+                                                       shape=shape)
+        self.weights = np.zeros(shape[1:], dtype=dtype)
+        if coverage:
+            self.coverage = np.zeros((3,) + shape[1:])
+        else:
+            self.coverage = None
+        self.files = []
+        self.header = header
+
+    def hasFile(self, filename):
+        return(os.path.abspath(filename) in self.files)
+
+    def addFile(self, filename):
+        self.files.append(os.path.abspath(filename))
+
+    def removeFile(self, filename):
+        if self.hasFile(filename):
+            self.files.remove(os.path.abspath(filename))
+
+    def cube(self):
+        """
+        Return the normalized cube.  Pixels with no weight are NaN.
+        """
+        return(self.numerator / self.weights[np.newaxis, :, :])
+
+    def save(self, checkpointDir):
+        """
+        Write the accumulators and file list to a checkpoint
+        directory.  Each file is written to a temporary name and
+        moved into place so an interrupted save leaves the previous
+        checkpoint intact.
+        """
+        if not os.path.isdir(checkpointDir):
+            os.makedirs(checkpointDir)
+        self.flush()
+        arrays = [(self.numeratorName, self.numerator),
+                  (self.weightsName, self.weights)]
+        if self.coverage is not None:
+            arrays += [(self.coverageName, self.coverage)]
+        elif os.path.isfile(os.path.join(checkpointDir, self.coverageName)):
+            # Stale maps would miss the files added since
+            os.remove(os.path.join(checkpointDir, self.coverageName))
+        for name, data in arrays:
+            target = os.path.join(checkpointDir, name)
+            # np.save appends .npy if missing, so keep it on the temp name
+            tmpname = target.replace('.npy', '.tmp.npy')
+            np.save(tmpname, data)
+            os.replace(tmpname, target)
+        target = os.path.join(checkpointDir, self.stateName)
+        with open(target + '.tmp', 'w') as fh:
+            json.dump({'files': self.files,
+                       'header': self.header,
+                       'shape': list(self.numerator.shape),
+                       'dtype': str(self.numerator.dtype)}, fh)
+        os.replace(target + '.tmp', target)
+
+    def flush(self):
+        if isinstance(self.numerator, np.memmap):
+            self.numerator.flush()
+
+    def release(self):
+        """
+        Drop the memory-mapped numerator file, if any.
+        """
+        if self.numeratorFile is not None:
+            del self.numerator
+            if os.path.isfile(self.numeratorFile):
+                os.remove(self.numeratorFile)
+            self.numeratorFile = None
+
+    @classmethod
+    def load(cls, checkpointDir, mmap_mode=None, numeratorFile=None):
+        """
+        Read accumulators from a checkpoint directory written by
+        `save`.
+
+        Parameters
+        ----------
+        checkpointDir : str
+            Checkpoint directory.
+
+        mmap_mode : str
+            Passed to `numpy.load` for the numerator.  Use 'r+' to
+            update the numerator on disk without reading it into memory.
+
+        numeratorFile : str
+            If given, the checkpoint numerator is copied to this file and
+            memory-mapped, leaving the checkpoint itself untouched.
+        """
+        with open(os.path.join(checkpointDir, cls.stateName)) as fh:
+            state = json.load(fh)
+        acc = cls.__new__(cls)
+        acc.numeratorFile = numeratorFile
+        if numeratorFile is None:
+            acc.numerator = np.load(os.path.join(checkpointDir,
+                                                 cls.numeratorName),
+                                    mmap_mode=mmap_mode)
+        else:
+            shutil.copyfile(os.path.join(checkpointDir, cls.numeratorName),
+                            numeratorFile)
+            acc.numerator = np.lib.format.open_memmap(numeratorFile,
+                                                      mode='r+')
+        acc.weights = np.load(os.path.join(checkpointDir, cls.weightsName))
+        coverageFile = os.path.join(checkpointDir, cls.coverageName)
+        if os.path.isfile(coverageFile):
+            acc.coverage = np.load(coverageFile)
+        else:
+            acc.coverage = None
+        acc.files = state['files']
+        acc.header = state['header']
+        return(acc)
+
+    @staticmethod
+    def exists(checkpointDir):
+        return(os.path.isfile(os.path.join(checkpointDir,
+                                           CubeAccumulator.stateName)))
+
+    @staticmethod
+    def remove(checkpointDir):
+        if os.path.isdir(checkpointDir):
+            shutil.rmtree(checkpointDir)
+
+
+def openAccumulator(shape, dtype=np.float64, header='',
+                    checkpointDir=None, resume=False, numeratorFile=None,
+                    coverage=False):
+    """
+    Return a `CubeAccumulator`, reloading it from `checkpointDir` when
+    resuming and a checkpoint exists.
+    """
+    if resume and checkpointDir is not None:
+        if CubeAccumulator.exists(checkpointDir):
+            acc = CubeAccumulator.load(checkpointDir,
+                                       numeratorFile=numeratorFile)
+            if (acc.header != header or
+                    acc.numerator.shape != tuple(int(n) for n in shape)):
+                raise ValueError('Checkpoint in {0} does not match the '
+                                 'requested grid'.format(checkpointDir))
+            if numeratorFile is None:
+                acc.numerator = acc.numerator.astype(dtype, copy=False)
+            elif acc.numerator.dtype != np.dtype(dtype):
+                raise ValueError('Checkpoint in {0} has data type '
+                                 '{1}'.format(checkpointDir,
+                                              acc.numerator.dtype))
+            if coverage and (acc.coverage is None):
+                raise ValueError('Checkpoint in {0} has no coverage '
+                                 'maps'.format(checkpointDir))
+            if not coverage:
+                acc.coverage = None
+            acc.weights = acc.weights.astype(dtype, copy=False)
+            print("Resuming from checkpoint with {0} files".format(
+                len(acc.files)))
+            return(acc)
+        warnings.warn('No checkpoint found in {0}; '
+                      'starting from scratch'.format(checkpointDir))
+    return(CubeAccumulator(shape, dtype=dtype, header=header,
+                           numeratorFile=numeratorFile, coverage=coverage))
+
+
+def accumulatorFromCube(cubeFile, weightsFile, dtype=np.float64,
+                        numeratorFile=None, slabSize=64):
+    """
+    Rebuild a `CubeAccumulator` from a cube written by `griddata` and
+    its weight image.  Since the cube is numerator / weights, the
+    numerator is cube * weights, with zero where the cube is blank.
+    The list of gridded files is not stored with a cube, so it is
+    empty.
+
+    Parameters
+    ----------
+    cubeFile, weightsFile : str
+        Cube and weight image (outname.fits and outname_wts.fits).
+
+    dtype : numpy.dtype
+        Data type of the accumulators.
+
+    numeratorFile : str
+        If given, the numerator is kept in a memory-mapped .npy file of
+        this name.
+
+    slabSize : int
+        Number of channels converted at a time.
+    """
+    header = fits.getheader(cubeFile)
+    weights = np.squeeze(fits.getdata(weightsFile))
+    with fits.open(cubeFile, memmap=True) as hdulist:
+        cube = hdulist[0].data
+        acc = CubeAccumulator(cube.shape, dtype=dtype,
+                              header=wcs.WCS(header).to_header_string(),
+                              numeratorFile=numeratorFile)
+        for chanStart in range(0, cube.shape[0], slabSize):
+            chanEnd = min(chanStart + slabSize, cube.shape[0])
+            acc.numerator[chanStart:chanEnd] = np.nan_to_num(
+                cube[chanStart:chanEnd] * weights[np.newaxis, :, :])
+    acc.weights[:] = weights
+    return(acc)
@@ -15,7 +15,7 @@ from .gbt_pipeline import *
 import numpy as np
 import glob
 import os
-# import fitsio
+import fitsio
 import copy
 import warnings
 import sys
@@ -316,6 +316,47 @@ def RowEnds(integrations, off_frac=0.25, **kwargs):
     OffMask[-int(off_frac*nIntegrations):] = True
     return(OffMask, 'RowEnds')
 
+def sessionBounds(allfiles, mapscans, badfeeds=[]):
+    """
+    Position bounds (minLon, maxLon, minLat, maxLat) of the map scans
+    of all feeds, read from the raw SDFITS files.  Only the position
+    columns are read.  Used to set up a streaming gridder before any
+    data are calibrated.  Returns None if none of the map scans are
+    found.
+    """
+    longitude = []
+    latitude = []
+    for infilename in allfiles:
+        sdf = SdFits()
+        indexfile = sdf.nameIndexFile(infilename)
+        row_list, _ = sdf.parseSdfitsIndex(indexfile, mapscans=mapscans)
+        infile = fitsio.FITS(infilename)
+        for thisfeed in row_list.feeds():
+            if thisfeed in badfeeds:
+                continue
+            for thisscan in mapscans:
+                try:
+                    rows = row_list.get(thisscan, thisfeed, 0, 0)
+                except KeyError:
+                    continue
+                positions = infile[rows['EXTENSION']].read(
+                    columns=['CRVAL2', 'CRVAL3'], rows=rows['ROW'])
+                longitude += [positions['CRVAL2']]
+                latitude += [positions['CRVAL3']]
+        infile.close()
+    if len(longitude) > 0:
+        longitude = np.concatenate(longitude)
+        latitude = np.concatenate(latitude)
+        # Same filtering as used to build the header
+        longitude = longitude[longitude != 0]
+        latitude = latitude[latitude != 0]
+    if (len(longitude) == 0) or (len(latitude) == 0):
+        warnings.warn('No map scans found in the input files')
+        return(None)
+    return(np.nanmin(longitude), np.nanmax(longitude),
+           np.nanmin(latitude), np.nanmax(latitude))
+
+
 def calscans(inputdir, start=82, stop=105, refscans=[80],
              badscans=[], badfeeds=[],
              outdir=None, log=None, loglevel='warning',
@@ -325,6 +366,8 @@ def calscans(inputdir, start=82, stop=105, refscans=[80],
              varrat=None, 
              smoothpca=False,
              aggregated=False,
+             gridder=None,
+             writeSdfits=True,
              **kwargs):
     """Main calibration routine
 
@@ -374,6 +417,15 @@ def calscans(inputdir, start=82, stop=105, refscans=[80],
     aggregated : bool
         If true use a single OFF reconstruction model for all rows in a scan. 
         Otherwise, do one row at a time
+    gridder : gbtpipe.Gridding.StreamGridder
+        If given, the calibrated spectra of each feed are handed to
+        the gridder in memory instead of being read back from the
+        SDFITS output.  If the gridder has neither a template header
+        nor bounds, the bounds of the map scans are read from the raw
+        data first.  Call gridder.write() afterwards to save the cube.
+    writeSdfits : bool
+        Write the calibrated SDFITS files.  Set to False together with
+        gridder to skip the intermediate files altogether.
     """
     
     # Grab them files
@@ -446,6 +498,10 @@ def calscans(inputdir, start=82, stop=105, refscans=[80],
     allfiles = glob.glob(input_directory + '/' +
                          os.path.basename(input_directory) +
                          '*.fits')
+    if ((gridder is not None) and (gridder.templateHeader is None)
+            and (gridder.bounds is None)):
+        gridder.bounds = sessionBounds(allfiles, cl_params.mapscans,
+                                       badfeeds=badfeeds)
     for filectr, infilename in enumerate(allfiles):
             log.doMessage('DBG', 'Attempting to calibrate',
                           os.path.basename(infilename).rstrip('.fits'))
@@ -482,7 +538,8 @@ def calscans(inputdir, start=82, stop=105, refscans=[80],
                                                    thiswin,
                                                    None, outdir=outdir,
                                                    suffix=suffix,
-                                                   log=log)
+                                                   log=log,
+                                                   writeSdfits=writeSdfits)
                 except KeyError:
                     pipe = None
                     pass
@@ -539,18 +596,25 @@ def calscans(inputdir, start=82, stop=105, refscans=[80],
                                                             varfrac=varfrac, varrat=varrat, 
                                                             smoothpca=smoothpca))
 
+                    blocks = []
                     for onoff in calonoffsets:
-                        for ctr, rownum in enumerate(onoff['rows']):
-                            # This updates the output SDFITS file with
-                            # the newly calibrated data.
-                            row = np.array([onoff['integs'].data[ctr]])
-                            row['DATA'] = onoff['TAstar'][ctr,:]
-                            row['TSYS'] = tsysStar
-                            row['TUNIT7'] = 'Ta*'
-                            pipe.outfile[-1].append(row)
+                        # Calibrated rows of this scan, as they are
+                        # written to the output SDFITS file.
+                        nrows = len(onoff['rows'])
+                        block = np.array(onoff['integs'].data[0:nrows])
+                        block['DATA'] = onoff['TAstar'][0:nrows, :]
+                        block['TSYS'] = tsysStar
+                        block['TUNIT7'] = 'Ta*'
+                        if writeSdfits:
+                            pipe.outfile[-1].append(block)
+                        if gridder is not None:
+                            blocks += [block]
+                    if (gridder is not None) and (len(blocks) > 0):
+                        gridder.add(np.concatenate(blocks), pipe.outfilename)
 
                     pipe.infile.close()
-                    pipe.outfile.close()
+                    if writeSdfits:
+                        pipe.outfile.close()
     return True
 
 def prepcal(thisscan, thisfeed=0, thispol=0,
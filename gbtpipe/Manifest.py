@@ -0,0 +1,186 @@
+import numpy as np
+import os
+import warnings
+from astropy.io import fits
+from multiprocessing import Pool
+
+# Scalar metadata taken from the first row of each file
+rowKeys = ['OBJECT', 'RESTFREQ', 'VELOCITY', 'VELDEF', 'TUNIT7',
+           'FRONTEND', 'CTYPE1', 'CRVAL1', 'CDELT1', 'CRPIX1',
+           'CTYPE2', 'CTYPE3', 'RADESYS', 'EQUINOX']
+
+
+def _scalar(value):
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        return(value.strip())
+    if isinstance(value, np.generic):
+        return(value.item())
+    return(value)
+
+
+def _describe(entry, data):
+    """
+    Fill in the first-row values and position bounds of entry from a
+    table of SDFITS rows.
+    """
+    for key in rowKeys:
+        entry[key] = _scalar(data[key][0])
+    objects = np.asarray(data['OBJECT'])
+    if objects.dtype.kind == 'S':
+        objects = np.char.decode(objects)
+    objects = np.char.strip(objects)
+    idx = (objects != 'VANE') * (objects != 'SKY')
+    # Feed and polarization pairs present, for per-feed cubes
+    names = getattr(data, 'names', None) or data.dtype.names
+    if ('FDNUM' in names) and ('PLNUM' in names):
+        pairs = np.stack([np.asarray(data['FDNUM'][idx], dtype=int),
+                          np.asarray(data['PLNUM'][idx], dtype=int)], axis=1)
+        entry['feedPol'] = [tuple(int(v) for v in pair)
+                            for pair in np.unique(pairs, axis=0)]
+    else:
+        entry['feedPol'] = []
+    longitude = np.array(data['CRVAL2'][idx], dtype=float)
+    latitude = np.array(data['CRVAL3'][idx], dtype=float)
+
+    # Same filtering as used to build the header
+    longitude = longitude[longitude != 0]
+    latitude = latitude[latitude != 0]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        entry['lonmin'] = np.nanmin(longitude) if longitude.size else np.nan
+        entry['lonmax'] = np.nanmax(longitude) if longitude.size else np.nan
+        entry['latmin'] = np.nanmin(latitude) if latitude.size else np.nan
+        entry['latmax'] = np.nanmax(latitude) if latitude.size else np.nan
+    entry['valid'] = True
+    return(entry)
+
+
+def scanFile(filename):
+    """
+    Collect the metadata of one SDFITS file without reading the
+    spectra.  Only the table header, the first row and the OBJECT and
+    position columns are read.
+
+    Parameters
+    ----------
+    filename : str
+        SDFITS file name
+
+    Returns
+    -------
+    entry : dict
+        Metadata with keys 'filename', 'valid', 'nrows', 'nchan', the
+        first-row values of `rowKeys`, the (FDNUM, PLNUM) pairs
+        'feedPol' and the position bounds 'lonmin', 'lonmax', 'latmin',
+        'latmax' of the rows that are not VANE or SKY scans.  Bounds are
+        NaN if there are no such rows.
+    """
+    entry = {'filename': filename, 'valid': False,
+             'nrows': 0, 'nchan': 0}
+    try:
+        with fits.open(filename, memmap=True) as hdulist:
+            if len(hdulist) < 2:
+                return(entry)
+            table = hdulist[1]
+            nrows = table.header.get('NAXIS2', 0)
+            entry['nrows'] = nrows
+            if nrows == 0:
+                return(entry)
+            entry['nchan'] = int(table.columns['DATA'].format.repeat)
+            # Column access on a memory-mapped table does not read DATA
+            return(_describe(entry, table.data))
+    except Exception:
+        return(entry)
+
+
+def describeRows(data, name=None):
+    """
+    Metadata for a table of SDFITS rows held in memory, e.g. calibrated
+    rows that were never written to disk, in the same form as
+    `scanFile`.  String values are decoded if the table holds bytes.
+
+    Parameters
+    ----------
+    data : `numpy.ndarray` or `astropy.io.fits.FITS_rec`
+        SDFITS rows
+
+    name : str
+        Name recorded as 'filename' in the entry.
+    """
+    entry = {'filename': name, 'valid': False,
+             'nrows': len(data), 'nchan': 0}
+    if len(data) == 0:
+        return(entry)
+    entry['nchan'] = len(data[0]['DATA'])
+    return(_describe(entry, data))
+
+
+class Manifest(object):
+    """
+    Per-file metadata for a list of SDFITS files, read once and shared
+    by `autoHeader`, `griddata` and `preprocess`.
+
+    Parameters
+    ----------
+    filelist : list
+        List of SDFITS files
+
+    nProc : int
+        Number of processes used to scan the files.
+    """
+    def __init__(self, filelist, nProc=1):
+        filelist = list(filelist)
+        if (nProc > 1) and (len(filelist) > 1):
+            with Pool(min(nProc, len(filelist))) as pool:
+                self.entries = pool.map(scanFile, filelist)
+        else:
+            self.entries = [scanFile(f) for f in filelist]
+        self.lookup = {}
+        for entry in self.entries:
+            self.lookup[os.path.abspath(entry['filename'])] = entry
+
+    def __getitem__(self, filename):
+        return(self.lookup[os.path.abspath(filename)])
+
+    def __contains__(self, filename):
+        return(os.path.abspath(filename) in self.lookup)
+
+    def __len__(self):
+        return(len(self.entries))
+
+    def validFiles(self):
+        """
+        Names of the files that can be gridded, in the original order.
+        """
+        return([e['filename'] for e in self.entries if e['valid']])
+
+    def invalidFiles(self):
+        return([e['filename'] for e in self.entries if not e['valid']])
+
+    def first(self):
+        """
+        Entry for the first valid file.
+        """
+        for entry in self.entries:
+            if entry['valid']:
+                return(entry)
+        return(None)
+
+    def bounds(self, filelist=None):
+        """
+        Return (minLon, maxLon, minLat, maxLat) over all valid files, or
+        over the valid files in filelist.
+        """
+        if filelist is None:
+            entries = self.entries
+        else:
+            entries = [self[f] for f in filelist]
+        valid = [e for e in entries if e['valid']]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return(np.nanmin([e['lonmin'] for e in valid]),
+                   np.nanmax([e['lonmax'] for e in valid]),
+                   np.nanmin([e['latmin'] for e in valid]),
+                   np.nanmax([e['latmax'] for e in valid]))
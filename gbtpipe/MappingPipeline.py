@@ -47,7 +47,7 @@ if CREATE_PLOTS:
 class MappingPipeline:
 
     def __init__(self, cl_params, row_list, feed, window, pol, term,
-                 outdir=None, suffix='', log=None):
+                 outdir=None, suffix='', log=None, writeSdfits=True):
 
         self.term = term
         self.log = log
@@ -79,7 +79,8 @@ class MappingPipeline:
         self.CLOBBER = cl_params.clobber
 
         try:
-            self.create_output_sdfits(feed, window, pol, suffix=suffix)
+            self.create_output_sdfits(feed, window, pol, suffix=suffix,
+                                      writeSdfits=writeSdfits)
         except KeyError:
             raise
 
@@ -242,7 +243,8 @@ class MappingPipeline:
 
         return dtype
 
-    def create_output_sdfits(self, feed, window, pol, suffix=''):
+    def create_output_sdfits(self, feed, window, pol, suffix='',
+                             writeSdfits=True):
 
         try:
             signalRows = self.row_list.get(self.cl.mapscans[0], feed, window, pol)
@@ -267,6 +269,10 @@ class MappingPipeline:
         if self.log is None:
             self.log = Logging(self.cl, self.outfilename.rstrip('.fits'))
 
+        if not writeSdfits:
+            # Only the name is set; outfile stays None
+            return self.infile[ext][0].dtype
+
         if self.CLOBBER is False and os.path.exists(self.outdir + self.outfilename):
             self.log.doMessage('WARN', ' Will not overwrite existing pipeline output.\nConsider using \'--clobber\' option to overwrite.')
             sys.exit()
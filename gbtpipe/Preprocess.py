@@ -5,6 +5,7 @@ from astropy.io import fits
 # import astropy.wcs as wcs
 import itertools
 from scipy.special import j1
+import scipy.sparse as sparse
 import pdb
 import numpy.fft as fft
 import astropy.utils.console as console
@@ -27,30 +28,145 @@ from . import __version__
 
 cms = 299792458.
 
-def buildMaskLookup(filename):
-    maskcube = SpectralCube.read(filename)
-    wcs = maskcube.wcs
-    mask = np.array(maskcube.filled_data[:], dtype=bool)
-    spatial_mask = np.any(mask, axis=0)        
-    nuinterp = interp1d(maskcube.spectral_axis.to(u.Hz).value,
-                        np.arange(maskcube.shape[0]),
-                        bounds_error=False,
-                        fill_value='extrapolate')
-    def maskLookup(ra, dec, freq):
-        xx, yy, zz = wcs.wcs_world2pix(ra, dec, freq, 0)
-        if (0 <= xx[0] < spatial_mask.shape[1] and
-            0 <= yy[0] < spatial_mask.shape[0]):
-            emission = spatial_mask[int(yy[0]), int(xx[0])]
-        else:
-            emission = False
-        if emission:
-            zz = np.array(nuinterp(freq), dtype=int)
-            zz[zz < 0] = 0
-            zz[zz >= mask.shape[0]] = mask.shape[0] - 1
-            return(mask[zz, yy.astype(int), xx.astype(int)])
-        else:
-            return(np.zeros_like(freq, dtype=bool))
-    return(maskLookup)
+class MaskLookup(object):
+    """
+    Emission mask of a mask cube, for looking up the channels of many
+    spectra to leave out of their baseline fits.  The mask is converted
+    to a boolean cube once, slab by slab, and the masks of all spectra
+    of a file come from one gather into it.
+
+    Parameters
+    ----------
+    filename : str
+        FITS mask cube, non-zero where there is emission.  It must be
+        in the same spectral space as the gridded cube.
+
+    cacheFile : str
+        If given, the boolean cube is kept in a memory-mapped .npy file
+        of this name, which is reused while it is newer than the mask
+        cube.  By default it is held in memory.
+
+    slabSize : int
+        Number of channels converted at a time.
+    """
+    def __init__(self, filename, cacheFile=None, slabSize=64):
+        maskcube = SpectralCube.read(filename)
+        self.wcs = maskcube.wcs
+        self.celestial = maskcube.wcs.celestial
+        shape = maskcube.shape
+        reuse = ((cacheFile is not None) and os.path.isfile(cacheFile)
+                 and (os.path.getmtime(cacheFile)
+                      >= os.path.getmtime(filename)))
+        if reuse:
+            self.mask = np.load(cacheFile, mmap_mode='r')
+            reuse = (self.mask.shape == shape)
+        if not reuse:
+            if cacheFile is None:
+                self.mask = np.zeros(shape, dtype=bool)
+            else:
+                self.mask = np.lib.format.open_memmap(cacheFile, mode='w+',
+                                                      dtype=bool,
+                                                      shape=shape)
+            for chanStart in range(0, shape[0], slabSize):
+                chanEnd = min(chanStart + slabSize, shape[0])
+                self.mask[chanStart:chanEnd] = np.array(
+                    maskcube.filled_data[chanStart:chanEnd], dtype=bool)
+            if cacheFile is not None:
+                self.mask.flush()
+        self.spatial_mask = np.zeros(shape[1:], dtype=bool)
+        for chanStart in range(0, shape[0], slabSize):
+            self.spatial_mask |= np.any(
+                self.mask[chanStart:chanStart + slabSize], axis=0)
+        self.nuinterp = interp1d(maskcube.spectral_axis.to(u.Hz).value,
+                                 np.arange(shape[0]),
+                                 bounds_error=False,
+                                 fill_value='extrapolate')
+
+    def channelIndex(self, freq):
+        zz = np.array(self.nuinterp(freq), dtype=int)
+        zz[zz < 0] = 0
+        zz[zz >= self.mask.shape[0]] = self.mask.shape[0] - 1
+        return(zz)
+
+    def pixelIndex(self, lon, lat):
+        """
+        Integer pixel of each position and whether it falls on a
+        spatial pixel with emission.
+        """
+        xx, yy = self.celestial.wcs_world2pix(lon, lat, 0)
+        inside = ((0 <= xx) & (xx < self.spatial_mask.shape[1])
+                  & (0 <= yy) & (yy < self.spatial_mask.shape[0]))
+        xx = np.where(inside, xx, 0).astype(int)
+        yy = np.where(inside, yy, 0).astype(int)
+        return(xx, yy, inside & self.spatial_mask[yy, xx])
+
+    def __call__(self, ra, dec, freq):
+        """
+        Mask of one spectrum at (ra[0], dec[0]) with frequency axis
+        freq (Hz).
+        """
+        xx, yy, emission = self.pixelIndex(np.atleast_1d(ra)[0:1],
+                                           np.atleast_1d(dec)[0:1])
+        if emission[0]:
+            return(self.mask[self.channelIndex(freq), yy[0], xx[0]])
+        return(np.zeros_like(freq, dtype=bool))
+
+    def lookup(self, lon, lat, spectralAxes, nchan, maxElements=2**24):
+        """
+        Masks of many spectra at once.
+
+        Parameters
+        ----------
+        lon, lat : np.array
+            Positions of the spectra in the frame of the mask cube.
+
+        spectralAxes : np.array
+            (CRPIX1, CDELT1, CRVAL1, DeltaNu) of each spectrum, giving
+            the frequency axis ((k + 1 - CRPIX1) * CDELT1 + CRVAL1)
+            + DeltaNu of channel k.  The channel mapping is computed
+            once for each distinct axis.
+
+        nchan : int
+            Number of channels in each spectrum.
+
+        maxElements : int
+            Largest number of mask values gathered in one step.
+
+        Returns
+        -------
+        masks : np.array
+            Boolean array with shape (nspec, nchan), True where there
+            is emission.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        spectralAxes = np.asarray(spectralAxes, dtype=float)
+        masks = np.zeros((len(lon), nchan), dtype=bool)
+        xx, yy, emission = self.pixelIndex(lon, lat)
+        rows = np.where(emission)[0]
+        if len(rows) == 0:
+            return(masks)
+        axes, which = np.unique(spectralAxes[rows], axis=0,
+                                return_inverse=True)
+        which = which.ravel()
+        chunk = max(1, int(maxElements // nchan))
+        channel = np.arange(nchan)[np.newaxis, :]
+        for start in range(0, len(axes), chunk):
+            thisaxes = axes[start:start + chunk]
+            freq = (((channel + 1 - thisaxes[:, 0:1]) * thisaxes[:, 1:2]
+                     + thisaxes[:, 2:3]) + thisaxes[:, 3:4])
+            zz = self.channelIndex(freq)
+            sel = np.where((which >= start) & (which < start + chunk))[0]
+            thisrows = rows[sel]
+            masks[thisrows] = self.mask[zz[which[sel] - start],
+                                        yy[thisrows][:, np.newaxis],
+                                        xx[thisrows][:, np.newaxis]]
+        return(masks)
+
+
+def buildMaskLookup(filename, cacheFile=None):
+    return(MaskLookup(filename, cacheFile=cacheFile))
+
 
 def drawTimeSeriesPlot(data, filename='TimeSeriesPlot',
                        suffix='png', outdir=None, plotsubdir='',
@@ -108,6 +224,281 @@ def channelShift(x, ChanShift):
     return(x2)
 
 
+def channelShiftBatch(x, ChanShift):
+    # Shift each row of a (nspec, nchan) array by its own number of
+    # channels.  Agrees with channelShift row by row to rounding.
+    nchan = x.shape[-1]
+    ftx = np.fft.rfft(x, axis=-1)
+    m = np.fft.rfftfreq(nchan)
+    phase = np.exp(2 * np.pi * m[np.newaxis, :] * 1j
+                   * np.asarray(ChanShift)[:, np.newaxis])
+    return(np.fft.irfft(ftx * phase, n=nchan, axis=-1))
+
+
+class ChannelShifter(object):
+    """
+    Shift spectra by fractional numbers of channels, as `channelShift`
+    does, with real FFTs and cached phase ramps.  A shift is split
+    into the nearest integer, applied with a roll, and a fraction of
+    at most half a channel, which is rounded to a multiple of quantum.
+    Phase ramps are kept for each rounded fraction, so rows of a file
+    with nearly equal Doppler shifts reuse them.  The shift error is at
+    most quantum / 2 channels.
+
+    Bad-channel masks are shifted without a transform: a channel is
+    flagged if either input channel it is interpolated from is
+    flagged.
+
+    Parameters
+    ----------
+    nchan : int
+        Number of channels in each spectrum.
+
+    quantum : float
+        Resolution of the fractional shifts in channels.  At most
+        1 / quantum + 1 ramps of nchan / 2 + 1 complex values are kept.
+    """
+    def __init__(self, nchan, quantum=0.01):
+        self.nchan = int(nchan)
+        self.quantum = float(quantum)
+        self.freq = np.fft.rfftfreq(self.nchan)
+        self.ramps = {}
+
+    def __repr__(self):
+        return('ChannelShifter({0}, quantum={1})'.format(self.nchan,
+                                                         self.quantum))
+
+    def split(self, ChanShift):
+        """
+        Integer part and quantized fraction (in units of quantum) of
+        one or more shifts.
+        """
+        ChanShift = np.asarray(ChanShift, dtype=float)
+        whole = np.round(ChanShift).astype(int)
+        key = np.round((ChanShift - whole) / self.quantum).astype(int)
+        return(whole, key)
+
+    def ramp(self, key):
+        key = int(key)
+        if key not in self.ramps:
+            self.ramps[key] = np.exp(2 * np.pi * 1j * self.freq
+                                     * key * self.quantum)
+        return(self.ramps[key])
+
+    def shift(self, x, ChanShift):
+        """
+        Shift one spectrum by ChanShift channels.
+        """
+        whole, key = self.split(ChanShift)
+        if key != 0:
+            x = np.fft.irfft(np.fft.rfft(x) * self.ramp(key), n=self.nchan)
+        return(np.roll(x, -whole))
+
+    def shiftMask(self, mask, ChanShift):
+        """
+        Shift a boolean mask of one spectrum by ChanShift channels.
+        """
+        whole, key = self.split(ChanShift)
+        mask = np.asarray(mask, dtype=bool)
+        if key != 0:
+            mask = mask | np.roll(mask, -1 if key > 0 else 1)
+        return(np.roll(mask, -whole))
+
+    def shiftRows(self, x, ChanShift):
+        """
+        Shift each row of a (nspec, nchan) array by its own number of
+        channels.  Rows with the same rounded fraction share one
+        transform call.
+        """
+        whole, key = self.split(ChanShift)
+        out = np.array(x, dtype=np.result_type(x, float))
+        for thiskey in np.unique(key):
+            if thiskey == 0:
+                continue
+            rows = np.where(key == thiskey)[0]
+            out[rows] = np.fft.irfft(np.fft.rfft(out[rows], axis=-1)
+                                     * self.ramp(thiskey)[np.newaxis, :],
+                                     n=self.nchan, axis=-1)
+        return(self.rollRows(out, whole))
+
+    def shiftMaskRows(self, mask, ChanShift):
+        """
+        Shift each row of a (nspec, nchan) boolean mask.
+        """
+        whole, key = self.split(ChanShift)
+        mask = np.asarray(mask, dtype=bool)
+        mask = (mask | (np.roll(mask, -1, axis=1) & (key > 0)[:, np.newaxis])
+                | (np.roll(mask, 1, axis=1) & (key < 0)[:, np.newaxis]))
+        return(self.rollRows(mask, whole))
+
+    def rollRows(self, x, whole):
+        index = (np.arange(self.nchan)[np.newaxis, :]
+                 + whole[:, np.newaxis]) % self.nchan
+        return(np.take_along_axis(x, index, axis=1))
+
+
+def baselineRows(x, blorder=1, baselineIndex=None):
+    """
+    Subtract a Legendre polynomial of order blorder from every row of
+    a 2D array, fitted to the channels selected by baselineIndex (all
+    channels by default) with one least-squares solve for all rows.
+    """
+    axis = np.linspace(-1, 1, x.shape[1])
+    if baselineIndex is None:
+        baselineIndex = slice(None)
+    coeffs = legendre.legfit(axis[baselineIndex], x[:, baselineIndex].T,
+                             blorder)
+    return(x - legendre.legval(axis, coeffs))
+
+
+def madRows(x):
+    # mad1d of each row of a 2D array
+    med0 = np.median(x, axis=1, keepdims=True)
+    return np.median(np.abs(x - med0), axis=1) * 1.4826
+
+
+def preprocessBatch(s, vframe_list, nData, startChannel, endChannel,
+                    nu0_template, cdelt3, convention='RADIO',
+                    doBaseline=True, blorder=1, flagRMS=True,
+                    rmsThresh=1.25, flagRipple=True, rippleThresh=2,
+                    spikeThresh=10, flagSpike=True, windowStrategy='simple',
+                    cubeMasks=None, edgefraction=0.05, gainDict=None,
+                    robust=False, shifter=None, **kwargs):
+    """
+    Process all spectra of a table at once, as the per-row loop of
+    `preprocess` does: Doppler shifts, spike flagging, baselines and
+    RMS/ripple flags are applied to the (nspec, nchan) DATA array.
+    Spectra sharing a baseline mask are fitted with one least-squares
+    solve.  The robust fit is still done spectrum by spectrum.  For
+    windowStrategy='cubemask', cubeMasks holds the emission mask of
+    every row of the table (see `MaskLookup.lookup`).  If a
+    `ChannelShifter` is given it applies the Doppler shifts.
+
+    Returns
+    -------
+    outscans, outwts, tsys : np.array
+        As returned by `preprocess`.
+
+    flagct : int
+        Number of spectra with Tsys set to zero.
+
+    rows : np.array
+        Index in s of the row of each output spectrum.
+    """
+    sqrt2 = np.sqrt(2)
+    prefac = 1.4826 / sqrt2
+
+    objects = np.asarray(s['OBJECT'])
+    if objects.dtype.kind == 'S':
+        objects = np.char.decode(objects)
+    objects = np.char.strip(objects)
+    rows = np.where((objects != 'VANE') & (objects != 'SKY'))[0]
+    nspec = len(rows)
+    nChannel = endChannel - startChannel
+    if nspec == 0:
+        return(np.zeros((0, nChannel)), np.zeros((0, nChannel)),
+               np.zeros(0), 0, rows)
+
+    specData = np.array(s['DATA'][rows])
+    badmask = ~np.isfinite(specData)
+    specData[badmask] = 0.0
+    badmask = badmask.astype(float)
+
+    crval1 = np.asarray(s['CRVAL1'][rows], dtype=float)
+    crpix1 = np.asarray(s['CRPIX1'][rows], dtype=float)
+    cdelt1 = np.asarray(s['CDELT1'][rows], dtype=float)
+    vframe = np.asarray(vframe_list)[rows]
+    DeltaNu = freqShiftValue(crval1, vframe, convention=convention) - crval1
+    DeltaChan = DeltaNu / cdelt3
+    nu0 = ((startChannel + 1 - crpix1) * cdelt1 + crval1) + DeltaNu
+    DeltaChan2 = (nu0_template - nu0) / cdelt3
+    if shifter is None:
+        specData = channelShiftBatch(specData, DeltaChan + DeltaChan2)
+        badmask = channelShiftBatch(badmask, DeltaChan + DeltaChan2)
+    else:
+        specData = shifter.shiftRows(specData, DeltaChan + DeltaChan2)
+        badmask = shifter.shiftMaskRows(badmask,
+                                        DeltaChan + DeltaChan2).astype(float)
+
+    noise = None
+    if flagSpike:
+        jumps = (specData - np.roll(specData, -1, axis=1))
+        noise = madRows(jumps) * 2**(-0.5)
+        spikemask = (np.abs(jumps) < spikeThresh * noise[:, np.newaxis])
+        spikemask = spikemask * np.roll(spikemask, 1, axis=1)
+        specData[~spikemask] = 0.0
+    else:
+        spikemask = np.ones_like(specData, dtype=bool)
+
+    baselineMask = np.zeros((nspec, nData), dtype=bool)
+    if windowStrategy == 'simple':
+        for r in simpleWindow(s[rows[0]], edgefraction=edgefraction,
+                              **kwargs):
+            baselineMask[:, r] = True
+    if windowStrategy == 'cubemask':
+        baselineMask[:] = True
+        baselineMask[:, 0:int(edgefraction * nData)] = False
+        baselineMask[:, int((1 - edgefraction) * nData):] = False
+        baselineMask[cubeMasks[rows]] = False
+    if windowStrategy == 'none':
+        baselineMask[:] = True
+
+    tsys = np.array(s['TSYS'][rows])
+    exposure = np.asarray(s['EXPOSURE'][rows])
+    masks, group = np.unique(baselineMask, axis=0, return_inverse=True)
+    group = group.ravel()
+    for g, mask in enumerate(masks):
+        members = np.where(group == g)[0]
+        if doBaseline:
+            finite = np.all(np.isfinite(specData[members][:, mask]), axis=1)
+            members_fit = members[finite]
+            if robust:
+                for i in members_fit:
+                    specData[i] = robustBaseline(
+                        specData[i], blorder=blorder, baselineIndex=mask,
+                        noiserms=None if noise is None else noise[i])
+            elif len(members_fit) > 0:
+                specData[members_fit] = baselineRows(
+                    specData[members_fit], blorder=blorder,
+                    baselineIndex=mask)
+
+        if flagRMS or flagRipple:
+            offSpec = specData[members][:, mask]
+            scan_rms = prefac * np.median(np.abs(offSpec[:, 0:-2] -
+                                                 offSpec[:, 2:]), axis=1)
+        if flagRMS:
+            radiometer_rms = tsys[members] / np.sqrt(
+                np.abs(cdelt1[members]) * exposure[members])
+            tsys[members[scan_rms > rmsThresh * radiometer_rms]] = 0
+        if flagRipple:
+            ripple = prefac * sqrt2 * np.median(np.abs(offSpec), axis=1)
+            tsys[members[ripple > rippleThresh * scan_rms]] = 0
+
+    if gainDict:
+        feedwt = np.zeros(nspec)
+        keep = np.zeros(nspec, dtype=bool)
+        for i, row in enumerate(rows):
+            try:
+                feedwt[i] = 1.0/gainDict[(str(s['FDNUM'][row]).strip(),
+                                          str(s['PLNUM'][row]).strip())]
+                keep[i] = True
+            except KeyError:
+                continue
+    else:
+        feedwt = np.ones(nspec)
+        keep = np.ones(nspec, dtype=bool)
+    flagct = int(np.sum(tsys[keep] == 0))
+
+    outslice = specData[:, startChannel:endChannel]
+    spectrum_wt = ((np.isfinite(outslice).astype(float)
+                    * spikemask[:, startChannel:endChannel]).astype(float)
+                   * feedwt[:, np.newaxis]
+                   * (badmask[:, startChannel:endChannel]
+                      < 1e-2).astype(float))
+    outslice = np.nan_to_num(outslice)
+    return(outslice[keep], spectrum_wt[keep], tsys[keep], flagct, rows[keep])
+
+
 def VframeInterpolator(scan):
     # Find cases where the scan number is
     startidx = scan['PROCSEQN']!=np.roll(scan['PROCSEQN'],1)
@@ -149,6 +540,149 @@ def VframeInterpolator(scan):
     return(vfit)
 
 
+def coaddIntegrations(data, maxSeparation):
+    """
+    Coadd runs of adjacent integrations that sample the same position.
+    Consecutive rows with the same OBJECT, SCAN, FDNUM, PLNUM and IFNUM
+    are combined while their positions stay within maxSeparation of
+    the first row of the run.  Spectra are averaged with weights
+    EXPOSURE / TSYS**2, ignoring non-finite channels, and the
+    positions likewise.  EXPOSURE is summed and TSYS set to the value
+    that gives the radiometer noise of the average.  Other columns are
+    those of the first row of the run.  Rows with no positive TSYS or
+    EXPOSURE are kept as they are.
+
+    Parameters
+    ----------
+    data : `astropy.io.fits.FITS_rec` or `numpy.ndarray`
+        SDFITS rows
+
+    maxSeparation : float
+        Largest distance (degrees) from the first row of a run.
+
+    Returns
+    -------
+    data : `astropy.io.fits.FITS_rec` or `numpy.ndarray`
+        Coadded rows, in the order of the first row of each run.  The
+        input is returned unchanged if no rows are combined.
+    """
+    nrows = len(data)
+    if nrows < 2:
+        return(data)
+    names = getattr(data, 'names', None) or data.dtype.names
+    keys = [key for key in ('OBJECT', 'SCAN', 'FDNUM', 'PLNUM', 'IFNUM')
+            if key in names]
+    lon = np.asarray(data['CRVAL2'], dtype=float)
+    lat = np.asarray(data['CRVAL3'], dtype=float)
+    tsys = np.asarray(data['TSYS'], dtype=float)
+    exposure = np.asarray(data['EXPOSURE'], dtype=float)
+    usable = (tsys > 0) & (exposure > 0)
+
+    # Label each row with its run; the last run of each key stays open
+    run = np.zeros(nrows, dtype=int)
+    anchors = {}
+    nrun = 0
+    for idx, key in enumerate(zip(*[data[k] for k in keys])):
+        anchor = anchors.get(key, None)
+        if (anchor is not None) and usable[idx] and usable[anchor]:
+            dlon = ((lon[idx] - lon[anchor] + 180) % 360) - 180
+            dlat = lat[idx] - lat[anchor]
+            separation = np.hypot(dlon * np.cos(np.radians(lat[anchor])),
+                                  dlat)
+            if separation <= maxSeparation:
+                run[idx] = run[anchor]
+                continue
+        anchors[key] = idx
+        run[idx] = nrun
+        nrun += 1
+    if nrun == nrows:
+        return(data)
+
+    first = np.unique(run, return_index=True)[1]
+    out = data[first].copy()
+    wt = np.where(usable, exposure / np.where(usable, tsys, 1.0)**2, 1.0)
+    coadd = sparse.csr_matrix((wt, (run, np.arange(nrows))),
+                              shape=(nrun, nrows))
+    spectra = np.asarray(data['DATA'], dtype=float)
+    good = np.isfinite(spectra)
+    numerator = coadd @ np.where(good, spectra, 0.0)
+    denominator = coadd @ good.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['DATA'] = np.where(denominator > 0,
+                               numerator / denominator, np.nan)
+
+    wtsum = np.bincount(run, weights=wt, minlength=nrun)
+    # Offsets from the first row avoid averaging across RA = 0
+    dlon = ((lon - lon[first][run] + 180) % 360) - 180
+    out['CRVAL2'] = (lon[first] + np.bincount(run, weights=wt * dlon,
+                                              minlength=nrun) / wtsum) % 360
+    out['CRVAL3'] = np.bincount(run, weights=wt * lat,
+                                minlength=nrun) / wtsum
+    merged = np.bincount(run, minlength=nrun) > 1
+    totalExposure = np.bincount(run, weights=exposure, minlength=nrun)
+    out['TSYS'] = np.where(merged, np.sqrt(totalExposure / wtsum),
+                           tsys[first])
+    out['EXPOSURE'] = totalExposure
+    if 'DURATION' in names:
+        out['DURATION'] = np.bincount(
+            run, weights=np.asarray(data['DURATION'], dtype=float),
+            minlength=nrun)
+    return(out)
+
+
+def tableChunks(filename, chunkSize=4096):
+    """
+    Yield blocks of at most chunkSize rows of the SDFITS table in
+    filename.  The table is memory-mapped, so only the rows of the
+    block being processed are read.
+    """
+    with fits.open(filename, memmap=True) as hdulist:
+        if len(hdulist) < 2:
+            return
+        table = hdulist[1].data
+        if table is None:
+            return
+        for start in range(0, len(table), chunkSize):
+            yield(table[start:start + chunkSize])
+
+
+def preprocessChunks(filename, chunkSize=4096, data=None, **kwargs):
+    """
+    Preprocess an SDFITS file in blocks of rows, so that peak memory
+    is set by chunkSize instead of the size of the file.  Keywords are
+    passed to `preprocess`, which is run on each block in turn.
+    Runs coadded with coaddFraction end at block edges.  Rows are not
+    screened for spatial outliers here; see `gridFileChunks`.
+    OnlineDoppler must be True.
+
+    Parameters
+    ----------
+    filename : str
+        SDFITS file
+
+    chunkSize : int
+        Number of rows per block.
+
+    data : `astropy.io.fits.FITS_rec`
+        SDFITS table already read from filename.  If None, blocks are
+        read from the memory-mapped file.
+
+    Yields
+    ------
+    rows, outscans, outwts, tsys : tuple
+        Output of `preprocess` for each block.
+    """
+    if not kwargs.get('OnlineDoppler', True):
+        raise ValueError('Chunked preprocessing requires OnlineDoppler=True')
+    if data is None:
+        chunks = tableChunks(filename, chunkSize=chunkSize)
+    else:
+        chunks = (data[start:start + chunkSize]
+                  for start in range(0, len(data), chunkSize))
+    for rows in chunks:
+        yield(preprocess(filename, data=rows, **kwargs))
+
+
 def preprocess(filename,
                startChannel=None,
                endChannel=None,
@@ -171,6 +705,13 @@ def preprocess(filename,
                outdir=None,
                plotsubdir='',
                robust=False,
+               data=None,
+               manifest=None,
+               coaddFraction=None,
+               batch=False,
+               shiftQuantum=None,
+               maskCache=None,
+               returnRows=False,
                **kwargs):
 
     """Scan pre-processing module for gbtpipe.  This baselines and flags
@@ -257,14 +798,60 @@ def preprocess(filename,
         file should have a value of 1 or True where there is emission
         to be excluded from the baseline fitting.
 
+    maskCache : str
+        File for a memory-mapped boolean copy of maskfile, see
+        `MaskLookup`.  By default the copy is held in memory.
+
     edgefraction : float
         Fraction of the band edges to be removed from the spectrum.
 
+    data : `astropy.io.fits.FITS_rec`
+        SDFITS table already read from filename.  If None, the table
+        is read from disk.
+
+    manifest : `gbtpipe.Manifest.Manifest`
+        File metadata shared with the gridder.  If given, the channel
+        count and velocity convention are taken from it.
+
+    coaddFraction : float
+        If set, runs of adjacent integrations of a row of the map whose
+        positions agree to this fraction of an output pixel are
+        coadded before processing, see `coaddIntegrations`.  Requires
+        OnlineDoppler=True.
+
+    batch : bool
+        Setting to True processes all spectra of the table at once
+        with `preprocessBatch` instead of one row at a time.  The
+        results agree with the per-row path to rounding.
+
+    shiftQuantum : float
+        If set, Doppler shifts are applied by a `ChannelShifter` with
+        this resolution in channels, which reuses phase ramps across
+        rows and shifts the bad-channel mask without a transform.  By
+        default every shift is computed exactly with `channelShift`.
+
+    returnRows : bool
+        Setting to True also returns the index of the table row of
+        each output spectrum.
+
 
     Returns
     -------
-    None
+    s : `astropy.io.fits.FITS_rec`
+        SDFITS table that was processed.  VANE and SKY rows, and rows
+        whose feed is missing from gainDict, have no output spectrum,
+        so the outputs do not line up with s in general.
+
+    outscans, outwts : np.array
+        Processed spectra and their channel weights, with shape
+        (nspec, endChannel - startChannel).
+
+    tsys : np.array
+        System temperature of each spectrum; zero if it was flagged.
 
+    rows : np.array
+        Only if returnRows is True.  Index in s of the row of each
+        output spectrum.
     """
 
     
@@ -275,9 +862,22 @@ def preprocess(filename,
     c = 299792458.
     ####################
 
-    s = fits.getdata(filename)
+    if data is None:
+        s = fits.getdata(filename)
+    else:
+        s = data
+
+    if coaddFraction:
+        if not OnlineDoppler:
+            raise ValueError('coaddFraction requires OnlineDoppler=True')
+        s = coaddIntegrations(s, coaddFraction * np.abs(wcs.cdelt[1]))
 
-    nData = len(s[0]['DATA'])
+    if (manifest is not None) and (filename in manifest):
+        nData = manifest[filename]['nchan']
+        doppler_conv = manifest[filename]['VELDEF']
+    else:
+        nData = len(s[0]['DATA'])
+        doppler_conv = s[0]['VELDEF']
 
     if startChannel is None:
         startChannel = int(edgefraction * nData)
@@ -291,7 +891,6 @@ def preprocess(filename,
     if outdir is None:
         outdir = os.getcwd()
 
-    doppler_conv = s[0]['VELDEF']
     if 'OPTI' in doppler_conv:
         convention = 'OPTICAL'
     if 'RADI' in doppler_conv:
@@ -329,129 +928,161 @@ def preprocess(filename,
                            plotsubdir=plotsubdir)
     
     if windowStrategy == 'cubemask':
-        maskLookup = buildMaskLookup(maskfile)
-
-    outscans = []
-    outwts = []
-    tsyslist = []
-    flagct = 0
-
-    for idx, (spectrum, vframe) in enumerate(zip(s, vframe_list)):
-        if spectrum['OBJECT'] == 'VANE' or spectrum['OBJECT'] == 'SKY':
-            continue
-
-        # This part takes the TOPOCENTRIC frequency that is at
-        # CRPIX1 (i.e., CRVAL1) and calculates the what frequency
-        # that would have in the LSRK frame with freqShiftValue.
-        # This then compares to the desired frequency CRVAL3.
-        specData = spectrum['DATA']
-        badmask = ~np.isfinite(specData)
-        specData[badmask] = 0.0
-        badmask = badmask.astype(float)
+        # Emission masks of all rows in one projection and gather
+        maskLookup = buildMaskLookup(maskfile, cacheFile=maskCache)
+        crval1 = np.asarray(s['CRVAL1'], dtype=float)
+        DeltaNu = (freqShiftValue(crval1, np.asarray(vframe_list,
+                                                     dtype=float),
+                                  convention=convention) - crval1)
+        cubeMasks = maskLookup.lookup(
+            s['CRVAL2'], s['CRVAL3'],
+            np.stack([np.asarray(s['CRPIX1'], dtype=float),
+                      np.asarray(s['CDELT1'], dtype=float),
+                      crval1, DeltaNu], axis=1), nData)
+    else:
+        cubeMasks = None
+
+    if shiftQuantum:
+        shifter = ChannelShifter(nData, quantum=shiftQuantum)
+    else:
+        shifter = None
+
+    if batch:
+        nu0_template = (1 - wcs.crpix[2]) * wcs.cdelt[2] + wcs.crval[2]
+        outscans, outwts, tsyslist, flagct, rows = preprocessBatch(
+            s, vframe_list, nData, startChannel, endChannel, nu0_template,
+            cdelt3, convention=convention, doBaseline=doBaseline,
+            blorder=blorder, flagRMS=flagRMS, rmsThresh=rmsThresh,
+            flagRipple=flagRipple, rippleThresh=rippleThresh,
+            spikeThresh=spikeThresh, flagSpike=flagSpike,
+            windowStrategy=windowStrategy,
+            cubeMasks=cubeMasks,
+            edgefraction=edgefraction, gainDict=gainDict, robust=robust,
+            shifter=shifter, **kwargs)
+        idx = len(s) - 1
+    else:
+        outscans = []
+        outwts = []
+        tsyslist = []
+        rows = []
+        flagct = 0
+
+        for idx, (spectrum, vframe) in enumerate(zip(s, vframe_list)):
+            if spectrum['OBJECT'] == 'VANE' or spectrum['OBJECT'] == 'SKY':
+                continue
+
+            # This part takes the TOPOCENTRIC frequency that is at
+            # CRPIX1 (i.e., CRVAL1) and calculates the what frequency
+            # that would have in the LSRK frame with freqShiftValue.
+            # This then compares to the desired frequency CRVAL3.
+            specData = spectrum['DATA'].copy()
+            badmask = ~np.isfinite(specData)
+            specData[badmask] = 0.0
+            badmask = badmask.astype(float)
         
         
-        DeltaNu = freqShiftValue(spectrum['CRVAL1'], vframe, convention=convention) - spectrum['CRVAL1']
-        DeltaChan = DeltaNu / cdelt3  # Shift from TOPO to SPECSYS
+            DeltaNu = freqShiftValue(spectrum['CRVAL1'], vframe, convention=convention) - spectrum['CRVAL1']
+            DeltaChan = DeltaNu / cdelt3  # Shift from TOPO to SPECSYS
         
-        spectral_axis = ((np.arange(nData) + 1 - spectrum['CRPIX1']) 
-                         * spectrum['CDELT1'] + spectrum['CRVAL1']) + DeltaNu
-        nu0 = spectral_axis[startChannel] # This is the SPECSYS value of first channel
-        # This is the SPECSYS value of the expected cube
-        nu0_template = (1 - wcs.crpix[2]) * wcs.cdelt[2] + wcs.crval[2] 
-        # These should line up so calculated ifference
-        DeltaNu2 = nu0_template - nu0
-        DeltaChan2 = DeltaNu2 / cdelt3 # Shift between desired spectrum 
+            spectral_axis = ((np.arange(nData) + 1 - spectrum['CRPIX1']) 
+                             * spectrum['CDELT1'] + spectrum['CRVAL1']) + DeltaNu
+            nu0 = spectral_axis[startChannel] # This is the SPECSYS value of first channel
+            # This is the SPECSYS value of the expected cube
+            nu0_template = (1 - wcs.crpix[2]) * wcs.cdelt[2] + wcs.crval[2] 
+            # These should line up so calculated ifference
+            DeltaNu2 = nu0_template - nu0
+            DeltaChan2 = DeltaNu2 / cdelt3 # Shift between desired spectrum 
             
-        # But the requested header may not align with actual observations so we need 
-        # the additional shift        
-        specData = channelShift(specData, DeltaChan + DeltaChan2)
-        badmask = channelShift(badmask, DeltaChan + DeltaChan2)
-        baselineMask = np.zeros_like(specData, dtype=bool)
-        noise = None
-        if flagSpike:
-            jumps = (specData - np.roll(specData, -1))
-            noise = mad1d(jumps) * 2**(-0.5)
-            spikemask = (np.abs(jumps) < spikeThresh * noise)
-            spikemask = spikemask * np.roll(spikemask, 1)
-            specData[~spikemask] = 0.0
-        else:
-            spikemask = np.ones_like(specData, dtype=bool)
-
-        if windowStrategy == 'simple':
-            baselineIndex = simpleWindow(spectrum,
-                                         edgefraction=edgefraction,
-                                         **kwargs)
-            for r in baselineIndex:
-                baselineMask[r] = True
-
-        if windowStrategy == 'cubemask':
-            baselineMask[:] = True
-            baselineMask[0:int(edgefraction * nData)] = False
-            baselineMask[int((1 - edgefraction) * nData):] = False
-            thismask = maskLookup((spectrum['CRVAL2'] 
-                                   * np.ones_like(spectral_axis)),
-                                  (spectrum['CRVAl3']
-                                   * np.ones_like(spectral_axis)),
-                                  spectral_axis)
-
-            baselineMask[np.squeeze(thismask.astype(bool))] = False
-
-        if windowStrategy == 'none':
-            baselineMask[:] = True
-
-        if doBaseline & np.all(np.isfinite(specData[baselineMask])):
-            if robust:
-                specData = robustBaseline(specData, blorder=blorder,
-                                          baselineIndex=baselineMask, 
-                                          noiserms=noise)
+            # But the requested header may not align with actual observations so we need 
+            # the additional shift        
+            if shifter is None:
+                specData = channelShift(specData, DeltaChan + DeltaChan2)
+                badmask = channelShift(badmask, DeltaChan + DeltaChan2)
             else:
-                specData = baselineSpectrum(specData, order=blorder,
-                                            baselineIndex=baselineMask)
-        if gainDict:
-            try:
-                feedwt = 1.0/gainDict[(str(spectrum['FDNUM']).strip(),
-                                        str(spectrum['PLNUM']).strip())]
-            except KeyError:
-                continue
-        else:
-            feedwt = 1.0
+                specData = shifter.shift(specData, DeltaChan + DeltaChan2)
+                badmask = shifter.shiftMask(
+                    badmask, DeltaChan + DeltaChan2).astype(float)
+            baselineMask = np.zeros_like(specData, dtype=bool)
+            noise = None
+            if flagSpike:
+                jumps = (specData - np.roll(specData, -1))
+                noise = mad1d(jumps) * 2**(-0.5)
+                spikemask = (np.abs(jumps) < spikeThresh * noise)
+                spikemask = spikemask * np.roll(spikemask, 1)
+                specData[~spikemask] = 0.0
+            else:
+                spikemask = np.ones_like(specData, dtype=bool)
+
+            if windowStrategy == 'simple':
+                baselineIndex = simpleWindow(spectrum,
+                                             edgefraction=edgefraction,
+                                             **kwargs)
+                for r in baselineIndex:
+                    baselineMask[r] = True
+
+            if windowStrategy == 'cubemask':
+                baselineMask[:] = True
+                baselineMask[0:int(edgefraction * nData)] = False
+                baselineMask[int((1 - edgefraction) * nData):] = False
+                baselineMask[cubeMasks[idx]] = False
+
+            if windowStrategy == 'none':
+                baselineMask[:] = True
+
+            if doBaseline & np.all(np.isfinite(specData[baselineMask])):
+                if robust:
+                    specData = robustBaseline(specData, blorder=blorder,
+                                              baselineIndex=baselineMask, 
+                                              noiserms=noise)
+                else:
+                    specData = baselineSpectrum(specData, order=blorder,
+                                                baselineIndex=baselineMask)
+            if gainDict:
+                try:
+                    feedwt = 1.0/gainDict[(str(spectrum['FDNUM']).strip(),
+                                            str(spectrum['PLNUM']).strip())]
+                except KeyError:
+                    continue
+            else:
+                feedwt = 1.0
 
-        tsys = spectrum['TSYS']
+            tsys = spectrum['TSYS']
         
-        if flagRMS:
-            offSpec = specData[baselineMask]
-            radiometer_rms = tsys / np.sqrt(np.abs(spectrum['CDELT1']) *
-                                            spectrum['EXPOSURE'])
-            scan_rms = prefac * np.median(np.abs(offSpec[0:-2] -
-                                                    offSpec[2:]))
-            if scan_rms > rmsThresh * radiometer_rms:
-                tsys = 0 # Blank spectrum
+            if flagRMS:
+                offSpec = specData[baselineMask]
+                radiometer_rms = tsys / np.sqrt(np.abs(spectrum['CDELT1']) *
+                                                spectrum['EXPOSURE'])
+                scan_rms = prefac * np.median(np.abs(offSpec[0:-2] -
+                                                        offSpec[2:]))
+                if scan_rms > rmsThresh * radiometer_rms:
+                    tsys = 0 # Blank spectrum
                 
-        if flagRipple:
-            offSpec = specData[baselineMask]
-            scan_rms = prefac * np.median(np.abs(offSpec[0:-2] -
-                                                    offSpec[2:]))
-            ripple = prefac * sqrt2 * np.median(np.abs(offSpec))
-
-            if ripple > rippleThresh * scan_rms:
-                tsys = 0 # Blank spectrum
-        if tsys == 0:
-            flagct +=1
+            if flagRipple:
+                offSpec = specData[baselineMask]
+                scan_rms = prefac * np.median(np.abs(offSpec[0:-2] -
+                                                        offSpec[2:]))
+                ripple = prefac * sqrt2 * np.median(np.abs(offSpec))
+
+                if ripple > rippleThresh * scan_rms:
+                    tsys = 0 # Blank spectrum
+            if tsys == 0:
+                flagct +=1
             
-        outslice = (specData)[startChannel:endChannel]
-
-        spectrum_wt = ((np.isfinite(outslice).astype(float)
-                        * spikemask[startChannel:
-                                    endChannel]).astype(float)
-                        * feedwt
-                        * (badmask[startChannel:endChannel] < 1e-2).astype(float))
-        outslice = np.nan_to_num(outslice)
-        outscans += [outslice]
-        outwts += [spectrum_wt]
-        tsyslist += [tsys]
+            outslice = (specData)[startChannel:endChannel]
+
+            spectrum_wt = ((np.isfinite(outslice).astype(float)
+                            * spikemask[startChannel:
+                                        endChannel]).astype(float)
+                            * feedwt
+                            * (badmask[startChannel:endChannel] < 1e-2).astype(float))
+            outslice = np.nan_to_num(outslice)
+            outscans += [outslice]
+            outwts += [spectrum_wt]
+            tsyslist += [tsys]
+            rows += [idx]
 
     print ("Percentage of flagged scans: {0:4.2f}".format(
-           100*flagct/float(idx)))
+           100*flagct/float(max(idx, 1))))
 
     # AFTER PLOT
     if plotTimeSeries:
@@ -461,4 +1092,7 @@ def preprocess(filename,
                            suffix='flagged.png',
                            flags=(np.array(tsyslist) == 0))
 
+    if returnRows:
+        return(s, np.array(outscans), np.array(outwts), np.array(tsyslist),
+               np.array(rows, dtype=int))
     return(s, np.array(outscans), np.array(outwts), np.array(tsyslist))
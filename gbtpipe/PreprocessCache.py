@@ -0,0 +1,138 @@
+import numpy as np
+import hashlib
+import os
+import shutil
+from .WeightCache import fileHash
+
+# Bump when the layout of the cached spectra changes
+cacheVersion = 2
+
+# preprocess keywords that do not change its output
+ignoredKeys = ('outdir', 'plotsubdir', 'plotTimeSeries', 'maskCache')
+
+arrayNames = ('outscans', 'outwts', 'tsys', 'rows')
+
+
+def _describe(value):
+    if isinstance(value, dict):
+        return(repr(sorted((repr(k), _describe(v))
+                           for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return(repr([_describe(v) for v in value]))
+    return(repr(value))
+
+
+def cacheKey(filename, wcs, startChannel, endChannel, **params):
+    """
+    Key for the preprocessed spectra of one file.
+
+    Parameters
+    ----------
+    filename : str
+        SDFITS file name.  The key uses the file contents, not the name.
+
+    wcs : `astropy.wcs.WCS`
+        WCS of the output cube.  Only the spectral axis enters the key.
+
+    startChannel, endChannel : int
+        Channel range passed to `preprocess`.
+
+    Any other keywords are the `preprocess` parameters, plus anything
+    that changes the rows handed to it (e.g. flagSpatialOutlier).  If
+    maskfile is given, its contents enter the key as well.
+
+    Returns
+    -------
+    key : str
+        Hex digest usable as a file name.
+    """
+    spectral = wcs.wcs
+    digest = hashlib.sha1()
+    items = [('version', cacheVersion),
+             ('file', fileHash(filename)),
+             ('spectral', (repr(float(spectral.crpix[2])),
+                           repr(float(spectral.cdelt[2])),
+                           repr(float(spectral.crval[2])),
+                           spectral.ctype[2], repr(spectral.restfrq),
+                           spectral.specsys)),
+             ('channels', (startChannel, endChannel))]
+    if params.get('maskfile', None) is not None:
+        items += [('maskHash', fileHash(params['maskfile']))]
+    items += sorted((name, _describe(value))
+                    for name, value in params.items()
+                    if name not in ignoredKeys)
+    for name, value in items:
+        digest.update('{0}={1};'.format(name, value).encode())
+    return(digest.hexdigest())
+
+
+def loadSpectra(cacheDir, key):
+    """
+    Return the cached (outscans, outwts, tsys, rows) for key as read-only
+    memory-mapped arrays, or None if they are not in the cache.  The
+    entry is marked as recently used.
+    """
+    entry = os.path.join(cacheDir, key)
+    if not os.path.isdir(entry):
+        return(None)
+    try:
+        arrays = tuple(np.load(os.path.join(entry, name + '.npy'),
+                               mmap_mode='r')
+                       for name in arrayNames)
+    except Exception:
+        # A damaged entry is just recomputed
+        return(None)
+    os.utime(entry)
+    return(arrays)
+
+
+def saveSpectra(cacheDir, key, spectra, maxBytes=None):
+    """
+    Store (outscans, outwts, tsys, rows) under key.  The entry is written to
+    a temporary directory and moved into place so that other processes
+    never read a partial entry.  If maxBytes is given, the least
+    recently used entries are then removed until the cache fits.
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+    target = os.path.join(cacheDir, key)
+    tmpname = os.path.join(cacheDir, '{0}.{1}.tmp'.format(key, os.getpid()))
+    os.makedirs(tmpname, exist_ok=True)
+    for name, data in zip(arrayNames, spectra):
+        np.save(os.path.join(tmpname, name + '.npy'), data)
+    try:
+        os.replace(tmpname, target)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmpname, ignore_errors=True)
+    if maxBytes is not None:
+        evict(cacheDir, maxBytes, keep=key)
+
+
+def entrySize(entry):
+    return(sum(os.path.getsize(os.path.join(entry, name))
+               for name in os.listdir(entry)))
+
+
+def evict(cacheDir, maxBytes, keep=None):
+    """
+    Remove the least recently used entries until the cache holds at
+    most maxBytes.  The entry named keep is never removed.
+    """
+    entries = []
+    for name in os.listdir(cacheDir):
+        entry = os.path.join(cacheDir, name)
+        if name.endswith('.tmp') or not os.path.isdir(entry):
+            continue
+        try:
+            entries += [(os.path.getmtime(entry), entrySize(entry), name)]
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= maxBytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cacheDir, name), ignore_errors=True)
+        total -= size
@@ -0,0 +1,251 @@
+import numpy as np
+import os
+import warnings
+from astropy.io import fits
+
+from .Gridding import (autoHeader, spectralAxis, outputWcs,
+                       addHeader_nonStd, writeNormalizedCube)
+from .Manifest import Manifest
+from .Preprocess import freqShiftValue, baselineRows
+from . import __version__
+
+
+def _convention(veldef):
+    if 'OPTI' in veldef:
+        return('OPTICAL')
+    if 'RELA' in veldef:
+        return('RELATIVISTIC')
+    return('RADIO')
+
+
+def binSpectra(numerator, weights, pixidx, spectra, wts):
+    """
+    Add spectra into the pixels given by pixidx with one reduction per
+    pixel rather than one update per spectrum.
+
+    Parameters
+    ----------
+    numerator : np.array
+        Pixel-major accumulator with shape (npix, nchan), updated in
+        place.
+
+    weights : np.array
+        Weight accumulator with shape (npix,), updated in place.
+
+    pixidx : np.array
+        Flat pixel index of each spectrum.
+
+    spectra : np.array
+        Spectra with shape (nspec, nchan), already multiplied by their
+        channel weights.
+
+    wts : np.array
+        Weight of each spectrum.
+    """
+    if len(pixidx) == 0:
+        return
+    order = np.argsort(pixidx, kind='stable')
+    pixidx = pixidx[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(pixidx)) + 1]
+    numerator[pixidx[starts]] += np.add.reduceat(
+        spectra[order] * wts[order, np.newaxis], starts, axis=0)
+    weights += np.bincount(pixidx, weights=wts, minlength=len(weights))
+
+
+def quicklook(filelist, pixPerBeam=3.5, spatialBin=1, spectralBin=1,
+              startChannel=None, endChannel=None, beamSize=None,
+              projection='TAN', outdir=None, outname=None,
+              doBaseline=True, blorder=1, innerfraction=0.2,
+              flagRMS=True, rmsThresh=1.25, flagRipple=True,
+              rippleThresh=2, edgefraction=0.05, dtype=np.float32):
+    """
+    Preview cube for quality assessment while observing.  Each
+    spectrum is put in the pixel nearest to its position with the same
+    1 / Tsys**2 weight as `griddata`, instead of being spread over the
+    beam by a gridding kernel, and the whole file is handled with array
+    operations on the DATA column.
+
+    The Doppler correction of each spectrum is rounded to a whole
+    channel, baselines are fitted to the output channels outside the
+    central innerfraction of each spectrum, and the flagRMS and
+    flagRipple tests of `preprocess` are applied to the baselined
+    spectrum in the same channels.  The cube is on the same grid as
+    `griddata` would use (from `autoHeader`) unless it is binned.
+
+    Parameters
+    ----------
+    filelist : list
+        List of FITS files to be gridded into an output
+
+    Keywords
+    --------
+    pixPerBeam : float
+        Number of pixels per beam FWHM of the full-resolution grid.
+
+    spatialBin : int
+        Pixels are spatialBin times larger than on the full-resolution
+        grid.
+
+    spectralBin : int
+        Average this many channels into each output channel.  Trailing
+        channels that do not fill a bin are dropped.
+
+    startChannel, endChannel : int
+        Channel range within the original spectral data.  Defaults to
+        the band without edgefraction at either end.
+
+    outname : str
+        Output file name.  Defaults to the object name with
+        '_quicklook' appended.
+
+    doBaseline : bool
+        Subtract a Legendre polynomial fitted to each spectrum before
+        flagging.  Without it, a sloped baseline fails the ripple
+        test.
+
+    blorder : int
+        Order of baseline.  Defaults to 1 (linear)
+
+    innerfraction : float
+        Central fraction of the output channels left out of the
+        baseline fit and the flag tests, where the line is expected.
+
+    flagRMS, rmsThresh, flagRipple, rippleThresh : bool, float
+        Flags as for `preprocess`.
+
+    dtype : numpy.dtype
+        Data type of the accumulators.
+
+    Returns
+    -------
+    None
+    """
+    sqrt2 = np.sqrt(2)
+    mad2rms = 1.4826
+    prefac = mad2rms / sqrt2
+    c = 299792458.
+
+    if outdir is None:
+        outdir = os.getcwd()
+    manifest = Manifest(filelist)
+    for file_i in manifest.invalidFiles():
+        warnings.warn('file {0} is corrupted'.format(file_i))
+    filelist = manifest.validFiles()
+    if len(filelist) == 0:
+        warnings.warn('There are no valid FITS files to process ')
+        return
+    first = manifest.first()
+    if outname is None:
+        outname = first['OBJECT'] + '_quicklook'
+    if beamSize is None:
+        beamSize = 1.18 * (c / first['RESTFREQ'] / 100.0) * 180 / np.pi
+    nData = first['nchan']
+    if startChannel is None:
+        startChannel = int(edgefraction * nData)
+    if endChannel is None:
+        endChannel = int((1 - edgefraction) * nData)
+    nChannel = (endChannel - startChannel) // spectralBin
+    endChannel = startChannel + nChannel * spectralBin
+
+    # Channel alignment uses the full-resolution spectral axis, as in
+    # preprocess; binning is applied afterwards.
+    crval3, crpix3, cdelt3, ctype3, naxis3 = spectralAxis(
+        first, startChannel, endChannel)
+    wcsdict = autoHeader(filelist, beamSize=beamSize,
+                         pixPerBeam=pixPerBeam / spatialBin,
+                         projection=projection, manifest=manifest)
+    w, naxis1, naxis2, _, _ = outputWcs(first,
+                                        (crval3, crpix3, cdelt3, ctype3),
+                                        wcsdict=wcsdict, beamSize=beamSize)
+    naxis1 = int(naxis1)
+    naxis2 = int(naxis2)
+    nu0_template = (1 - w.wcs.crpix[2]) * w.wcs.cdelt[2] + w.wcs.crval[2]
+    # Baseline channels, as for windowStrategy='simple' in preprocess
+    window = np.ones(endChannel - startChannel, dtype=bool)
+    window[int((0.5 - innerfraction / 2) * len(window)):
+           int((0.5 + innerfraction / 2) * len(window))] = False
+
+    numerator = np.zeros((naxis1 * naxis2, nChannel), dtype=dtype)
+    weights = np.zeros(naxis1 * naxis2, dtype=dtype)
+    for thisfile in filelist:
+        print("Now processing {0}".format(thisfile))
+        entry = manifest[thisfile]
+        convention = _convention(entry['VELDEF'])
+        with fits.open(thisfile, memmap=True) as hdulist:
+            table = hdulist[1].data
+            objects = np.char.strip(np.asarray(table['OBJECT']).astype(str))
+            rows = np.flatnonzero((objects != 'VANE') & (objects != 'SKY'))
+            if len(rows) == 0:
+                continue
+            crval1 = np.asarray(table['CRVAL1'][rows], dtype=float)
+            crpix1 = np.asarray(table['CRPIX1'][rows], dtype=float)
+            cdelt1 = np.asarray(table['CDELT1'][rows], dtype=float)
+            tsys = np.asarray(table['TSYS'][rows], dtype=float)
+            exposure = np.asarray(table['EXPOSURE'][rows], dtype=float)
+            longitude = np.asarray(table['CRVAL2'][rows], dtype=float)
+            latitude = np.asarray(table['CRVAL3'][rows], dtype=float)
+
+            # Same shift as preprocess, rounded to whole channels
+            DeltaNu = (freqShiftValue(crval1, table['VFRAME'][rows],
+                                      convention=convention) - crval1)
+            nu0 = ((startChannel + 1 - crpix1) * cdelt1 + crval1 + DeltaNu)
+            shift = np.round((DeltaNu + nu0_template - nu0)
+                             / entry['CDELT1']).astype(int)
+            chans = (startChannel + shift[:, np.newaxis]
+                     + np.arange(endChannel - startChannel)) % nData
+            spectra = np.asarray(table['DATA'][rows],
+                                 dtype=float)[np.arange(len(rows))[:, np.newaxis],
+                                              chans]
+
+        specwts = np.isfinite(spectra).astype(float)
+        spectra = np.nan_to_num(spectra)
+        if doBaseline:
+            spectra = baselineRows(spectra, blorder=blorder,
+                                   baselineIndex=window)
+        flagged = np.zeros(len(rows), dtype=bool)
+        if flagRMS or flagRipple:
+            offSpec = spectra[:, window]
+            scan_rms = prefac * np.median(np.abs(offSpec[:, 0:-2]
+                                                 - offSpec[:, 2:]), axis=1)
+        if flagRMS:
+            radiometer_rms = tsys / np.sqrt(np.abs(cdelt1) * exposure)
+            flagged |= scan_rms > rmsThresh * radiometer_rms
+        if flagRipple:
+            ripple = prefac * sqrt2 * np.median(np.abs(offSpec), axis=1)
+            flagged |= ripple > rippleThresh * scan_rms
+        print("Percentage of flagged scans: {0:4.2f}".format(
+            100 * flagged.sum() / float(len(rows))))
+
+        if spectralBin > 1:
+            spectra = (spectra * specwts).reshape(
+                (len(rows), nChannel, spectralBin)).sum(axis=2)
+            specwts = specwts.reshape(
+                (len(rows), nChannel, spectralBin)).sum(axis=2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                spectra = np.where(specwts > 0, spectra / specwts, 0.0)
+            specwts = (specwts > 0).astype(float)
+
+        xpix, ypix = w.celestial.wcs_world2pix(longitude, latitude, 0)
+        xpix = np.round(xpix).astype(int)
+        ypix = np.round(ypix).astype(int)
+        good = np.flatnonzero((~flagged) & (tsys > 10)
+                              & (xpix >= 0) & (xpix < naxis1)
+                              & (ypix >= 0) & (ypix < naxis2))
+        binSpectra(numerator, weights, ypix[good] * naxis1 + xpix[good],
+                   spectra[good] * specwts[good], 1 / tsys[good]**2)
+
+    hdr = fits.Header(w.to_header())
+    if spectralBin > 1:
+        hdr['CDELT3'] = w.wcs.cdelt[2] * spectralBin
+        hdr['CRPIX3'] = (w.wcs.crpix[2] - (spectralBin + 1) / 2.
+                         ) / spectralBin + 1
+    hdr = addHeader_nonStd(hdr, beamSize, first)
+    hdr.add_history('Quick-look cube from GBTPIPE version {0}'.format(
+        __version__))
+    cube = numerator.T.reshape((nChannel, naxis2, naxis1))
+    writeNormalizedCube(outdir + '/' + outname + '.fits', cube,
+                        weights.reshape((naxis2, naxis1)), hdr)
+    hdr2 = fits.Header(w.dropaxis(2).to_header())
+    hdu2 = fits.PrimaryHDU(weights.reshape((1, naxis2, naxis1)),
+                           header=hdr2)
+    hdu2.writeto(outdir + '/' + outname + '_wts.fits', overwrite=True)
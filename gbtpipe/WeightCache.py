@@ -0,0 +1,117 @@
+import numpy as np
+import hashlib
+import os
+
+# Bump when the layout of the cached tables changes
+cacheVersion = 1
+
+
+# Digests already computed, by file path, size and modification time
+fileHashes = {}
+
+
+def fileHash(filename, blockSize=2**20):
+    """
+    SHA1 digest of the contents of a file, read in blocks.  The digest
+    is remembered for the file's path, size, modification time and
+    inode, so a file is only read again after it changes.
+    """
+    stat = os.stat(filename)
+    stamp = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns,
+             stat.st_ino)
+    if stamp in fileHashes:
+        return(fileHashes[stamp])
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        block = fh.read(blockSize)
+        while block:
+            digest.update(block)
+            block = fh.read(blockSize)
+    fileHashes[stamp] = digest.hexdigest()
+    return(fileHashes[stamp])
+
+
+def kernelName(gridFunction):
+    """
+    Name identifying a gridding function, e.g. 'gbtpipe.Gridding.jincGrid'.
+    Tabulated kernels are identified by their repr.
+    """
+    name = getattr(gridFunction, '__name__', None)
+    if name is None:
+        return(repr(gridFunction))
+    return('{0}.{1}'.format(gridFunction.__module__, name))
+
+
+def cacheKey(filename, w, naxis1, naxis2, gridFunction, pixPerBeam,
+             **flags):
+    """
+    Key for the weight table of one file on one output grid.
+
+    Parameters
+    ----------
+    filename : str
+        SDFITS file name.  The key uses the file contents, not the name.
+
+    w : `astropy.wcs.WCS`
+        WCS of the output cube.  Only the celestial part enters the key.
+
+    naxis1, naxis2 : int
+        Spatial size of the output cube.
+
+    gridFunction : function
+        Gridding function.
+
+    pixPerBeam : float
+        Number of pixels per beam FWHM
+
+    Any other keywords (e.g. eulerFlag) that change the positions are
+    included in the key as well.
+
+    Returns
+    -------
+    key : str
+        Hex digest usable as a file name.
+    """
+    digest = hashlib.sha1()
+    items = [('version', cacheVersion),
+             ('file', fileHash(filename)),
+             ('header', w.celestial.to_header_string()),
+             ('naxis', (int(naxis1), int(naxis2))),
+             ('kernel', kernelName(gridFunction)),
+             ('pixPerBeam', repr(float(pixPerBeam)))]
+    items += sorted(flags.items())
+    for name, value in items:
+        digest.update('{0}={1};'.format(name, value).encode())
+    return(digest.hexdigest())
+
+
+def loadTable(cacheDir, key):
+    """
+    Return the cached (specidx, pixidx, kernelwt) table for key, or
+    None if it is not in the cache.
+    """
+    filename = os.path.join(cacheDir, key + '.npz')
+    if not os.path.isfile(filename):
+        return(None)
+    try:
+        with np.load(filename) as cached:
+            return((cached['specidx'], cached['pixidx'], cached['kernelwt']))
+    except Exception:
+        # A damaged entry is just recomputed
+        return(None)
+
+
+def saveTable(cacheDir, key, table):
+    """
+    Store a (specidx, pixidx, kernelwt) table under key.  The entry is
+    written to a temporary name and moved into place so that other
+    processes never read a partial file.
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+    specidx, pixidx, kernelwt = table
+    target = os.path.join(cacheDir, key + '.npz')
+    tmpname = os.path.join(cacheDir,
+                           '{0}.{1}.tmp.npz'.format(key, os.getpid()))
+    np.savez(tmpname, specidx=specidx, pixidx=pixidx, kernelwt=kernelwt)
+    os.replace(tmpname, target)
@@ -21,7 +21,8 @@ if not _ASTROPY_SETUP_:
     from .SdFitsIO import SdFits, SdFitsIndexRowReader
     from .smoothing import *
     from .commandline import CommandLine
-    from .Gridding import griddata
+    from .Gridding import griddata, StreamGridder
+    from .QuickLook import quicklook
     from .Baseline import *
     from .gbt_pipeline import *
 
@@ -0,0 +1,93 @@
+"""
+Small synthetic SDFITS files for the gridding tests.
+"""
+import numpy as np
+from astropy.io import fits
+
+restfreq = 23.6944955e9
+
+
+def makeSdfits(filename, nrow=12, ncol=10, nchan=128, seed=0,
+               lon0=30.0, lat0=0.0, step=0.004, noise=0.1, slope=0.0,
+               nfeed=1, insert=None):
+    """
+    Write an SDFITS file of a raster map in Galactic coordinates with
+    a Gaussian line at the band centre.
+
+    Parameters
+    ----------
+    nrow, ncol : int
+        Size of the raster; one spectrum per position.
+
+    slope : float
+        Amplitude of a linear baseline across the band, in K.
+
+    nfeed : int
+        Positions are assigned to feeds 0 .. nfeed - 1 in turn, with
+        PLNUM alternating between 0 and 1 along each row.
+
+    insert : dict
+        Map from row index to OBJECT name (e.g. 'VANE').  A row with
+        that name and junk data, at the map centre, is inserted before
+        the given map row.
+
+    Returns
+    -------
+    data : `astropy.io.fits.FITS_rec`
+        The table that was written.
+    """
+    rng = np.random.default_rng(seed)
+    lat, lon = np.divmod(np.arange(nrow * ncol), ncol)
+    lon = lon0 + lon * step
+    lat = lat0 + lat * step
+    chan = np.arange(nchan)
+    line = 3.0 * np.exp(-(chan - nchan / 2)**2 / (2 * 5**2))
+    baseline = slope * np.linspace(-1, 1, nchan)
+    spectra = (line + baseline)[np.newaxis, :] + rng.normal(
+        0, noise, (nrow * ncol, nchan))
+    objects = np.array(['SRC'] * (nrow * ncol), dtype='U16')
+    fdnum = np.arange(nrow * ncol) % nfeed
+    plnum = np.arange(nrow * ncol) % 2
+    exposure = 1.0 + 0.01 * np.arange(nrow * ncol)
+    scan = np.arange(nrow * ncol) // ncol
+    for index in sorted(insert or {}, reverse=True):
+        objects = np.insert(objects, index, insert[index])
+        lon = np.insert(lon, index, lon0 + step * ncol / 2)
+        lat = np.insert(lat, index, lat0 + step * nrow / 2)
+        spectra = np.insert(spectra, index, 100.0, axis=0)
+        fdnum = np.insert(fdnum, index, nfeed)
+        plnum = np.insert(plnum, index, 0)
+        exposure = np.insert(exposure, index, 10.0)
+        scan = np.insert(scan, index, scan[min(index, len(scan) - 1)])
+    n = len(objects)
+    cols = [
+        fits.Column('OBJECT', '16A', array=objects),
+        fits.Column('RESTFREQ', 'D', array=np.full(n, restfreq)),
+        fits.Column('VELOCITY', 'D', array=np.zeros(n)),
+        fits.Column('VELDEF', '8A', array=['RADI-LSR'] * n),
+        fits.Column('TUNIT7', '6A', array=['Ta*'] * n),
+        fits.Column('FRONTEND', '16A', array=['RcvrArray18_26'] * n),
+        fits.Column('CTYPE1', '8A', array=['FREQ-OBS'] * n),
+        fits.Column('CRVAL1', 'D', array=np.full(n, restfreq)),
+        fits.Column('CDELT1', 'D', array=np.full(n, 5.7e3)),
+        fits.Column('CRPIX1', 'D', array=np.full(n, nchan / 2 + 1)),
+        fits.Column('CTYPE2', '8A', array=['GLON'] * n),
+        fits.Column('CTYPE3', '8A', array=['GLAT'] * n),
+        fits.Column('RADESYS', '8A', array=[''] * n),
+        fits.Column('EQUINOX', 'D', array=np.full(n, 2000.0)),
+        fits.Column('CRVAL2', 'D', array=lon),
+        fits.Column('CRVAL3', 'D', array=lat),
+        fits.Column('TSYS', 'D', array=np.full(n, 40.0)),
+        fits.Column('EXPOSURE', 'D', array=exposure),
+        fits.Column('VFRAME', 'D', array=np.zeros(n)),
+        fits.Column('PROCSEQN', 'J', array=scan),
+        fits.Column('SCAN', 'J', array=scan),
+        fits.Column('FDNUM', 'J', array=fdnum),
+        fits.Column('PLNUM', 'J', array=plnum),
+        fits.Column('IFNUM', 'J', array=np.zeros(n, dtype=int)),
+        fits.Column('DATA', '{0}E'.format(nchan),
+                    array=spectra.astype(np.float32)),
+    ]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+    return(hdu.data)
@@ -0,0 +1,8 @@
+import pytest
+
+from ..ArgusCal import sessionBounds
+
+
+def test_session_bounds_empty():
+    with pytest.warns(UserWarning, match='No map scans'):
+        assert sessionBounds([], [80, 81]) is None
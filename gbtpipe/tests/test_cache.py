@@ -0,0 +1,25 @@
+import os
+import builtins
+
+from .. import WeightCache
+
+
+def test_file_hash_once(monkeypatch, tmp_path):
+    filename = tmp_path / 'data.fits'
+    filename.write_bytes(b'a' * 1000)
+    opened = []
+
+    def countingOpen(name, *args, **kwargs):
+        opened.append(name)
+        return(builtins.open(name, *args, **kwargs))
+
+    monkeypatch.setattr(WeightCache, 'open', countingOpen, raising=False)
+    first = WeightCache.fileHash(str(filename))
+    assert WeightCache.fileHash(str(filename)) == first
+    assert len(opened) == 1
+    # A changed file is read again
+    filename.write_bytes(b'b' * 1000)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert WeightCache.fileHash(str(filename)) != first
+    assert len(opened) == 2
@@ -0,0 +1,278 @@
+import json
+import warnings
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from ..Gridding import griddata, gridFile
+from .synthetic import makeSdfits
+
+gridKwargs = dict(flagRMS=False, flagRipple=False, flagSpike=False,
+                  pixPerBeam=3.5, startChannel=32, endChannel=96)
+
+
+def grid(outdir, filelist, outname, **kwargs):
+    """
+    Grid filelist into outdir and return the cube.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        griddata([str(f) for f in filelist], outdir=str(outdir),
+                 outname=outname, **dict(gridKwargs, **kwargs))
+    return(fits.getdata(str(outdir / (outname + '.fits'))))
+
+
+def assertSameCube(cube, reference, rtol=1e-10):
+    assert cube.shape == reference.shape
+    assert np.all(np.isnan(cube) == np.isnan(reference))
+    good = np.isfinite(reference)
+    np.testing.assert_allclose(cube[good], reference[good], rtol=rtol,
+                               atol=rtol)
+
+
+@pytest.fixture
+def datadir(tmp_path):
+    path = tmp_path / 'data'
+    path.mkdir()
+    return(path)
+
+
+@pytest.mark.parametrize('options', [{}, {'batch': True},
+                                     {'chunkSize': 50},
+                                     {'weightCache': True},
+                                     {'preprocessCache': True},
+                                     {'splitFeeds': 'feed'},
+                                     {'coverageMaps': True}])
+def test_skipped_rows(tmp_path, datadir, options):
+    # VANE and SKY rows have no preprocessed spectrum; the spectra
+    # after them must still be gridded at their own positions.
+    makeSdfits(datadir / 'plain.fits', nfeed=2)
+    makeSdfits(datadir / 'vane.fits', nfeed=2,
+               insert={0: 'VANE', 37: 'SKY', 80: 'VANE'})
+    for cache in ('weightCache', 'preprocessCache'):
+        if cache in options:
+            options = dict(options, **{cache: str(tmp_path / cache)})
+    reference = grid(tmp_path, [datadir / 'plain.fits'], 'plain', **options)
+    cube = grid(tmp_path, [datadir / 'vane.fits'], 'vane', **options)
+    assertSameCube(cube, reference)
+    suffixes = []
+    if 'splitFeeds' in options:
+        suffixes += ['_feed0', '_feed1']
+    if 'coverageMaps' in options:
+        suffixes += ['_hits', '_noise', '_exposure']
+    for suffix in suffixes:
+        assertSameCube(
+            fits.getdata(str(tmp_path / ('vane' + suffix + '.fits'))),
+            fits.getdata(str(tmp_path / ('plain' + suffix + '.fits'))))
+
+
+def test_skipped_feed(tmp_path, datadir):
+    # Rows of a feed missing from gainDict are dropped by preprocess
+    makeSdfits(datadir / 'plain.fits')
+    makeSdfits(datadir / 'extra.fits', insert={5: 'SRC', 60: 'SRC'})
+    gainDict = {('0', '0'): 1.0, ('0', '1'): 1.0}
+    cube = grid(tmp_path, [datadir / 'plain.fits'], 'plain')
+    header = fits.getheader(str(tmp_path / 'plain.fits'))
+    reference, result = [
+        gridFile(str(datadir / name), w=WCS(header), naxis1=cube.shape[2],
+                 naxis2=cube.shape[1], gainDict=gainDict, **gridKwargs)
+        for name in ('plain.fits', 'extra.fits')]
+    for expected, actual in zip(reference[0:3] + reference[4:],
+                                result[0:3] + result[4:]):
+        np.testing.assert_array_equal(actual, expected)
+    for expected, actual in zip(reference[3], result[3]):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_cygrid_backend(tmp_path, datadir):
+    pytest.importorskip('cygrid')
+    from ..Gridding import gaussGrid
+    makeSdfits(datadir / 'a.fits', seed=1)
+    makeSdfits(datadir / 'b.fits', seed=2, lat0=0.02)
+    files = [datadir / 'a.fits', datadir / 'b.fits']
+    reference = grid(tmp_path, files, 'numpy', gridFunction=gaussGrid)
+    cube = grid(tmp_path, files, 'cygrid', backend='cygrid',
+                gridFunction=gaussGrid)
+    # Slabs are gridded with a new cygrid gridder for each file
+    slabs = grid(tmp_path, files, 'slabs', backend='cygrid',
+                 gridFunction=gaussGrid, memoryBudget=2e5)
+    assertSameCube(slabs, cube)
+    good = np.isfinite(reference) & np.isfinite(cube)
+    np.testing.assert_allclose(cube[good], reference[good], atol=1e-5)
+
+
+def test_cygriddata_defaults(monkeypatch, tmp_path):
+    from .. import CyGridding
+    calls = []
+    monkeypatch.setattr(CyGridding, 'griddata',
+                        lambda filelist, **kwargs: calls.append(kwargs))
+    CyGridding.cygriddata(['a.fits'], outdir=str(tmp_path))
+    CyGridding.cygriddata(['a.fits'], cacheSpectra=True, flagRMS=True,
+                          outdir=str(tmp_path))
+    assert calls[0]['backend'] == 'cygrid'
+    assert (calls[0]['startChannel'], calls[0]['endChannel']) == (1024, 3072)
+    assert not (calls[0]['flagRMS'] or calls[0]['flagRipple']
+                or calls[0]['flagSpike'])
+    assert 'preprocessCache' not in calls[0]
+    assert calls[1]['flagRMS']
+    assert calls[1]['preprocessCache'] == str(tmp_path / 'speccache')
+
+
+def test_coverage_noise(tmp_path, datadir):
+    # Noise at the radiometer level of the synthetic Tsys and exposure
+    rms = 40.0 / np.sqrt(5.7e3 * 1.5)
+    makeSdfits(datadir / 'noise.fits', noise=rms)
+    cube = grid(tmp_path, [datadir / 'noise.fits'], 'noise',
+                coverageMaps=True, startChannel=0, endChannel=40)
+    noise = fits.getdata(str(tmp_path / 'noise_noise.fits'))[0]
+    assert fits.getheader(str(tmp_path / 'noise_noise.fits'))['BUNIT'] == 'K'
+    hits = fits.getdata(str(tmp_path / 'noise_hits.fits'))[0]
+    inner = hits > 10
+    ratio = np.nanstd(cube, axis=0)[inner] / noise[inner]
+    assert abs(np.median(ratio) - 1) < 0.1
+
+    # The gainDict feed weights scale the spectra, and so the noise
+    from ..Gridding import accumulateCoverage, makeCoverageMaps
+    header = fits.getheader(str(tmp_path / 'noise.fits'))
+    maps = []
+    for gain in (1.0, 2.0):
+        gainDict = {('0', '0'): gain, ('0', '1'): gain}
+        result = gridFile(str(datadir / 'noise.fits'), w=WCS(header),
+                          naxis1=cube.shape[2], naxis2=cube.shape[1],
+                          gainDict=gainDict, **gridKwargs)
+        outscan, specwts, tsys, table, exposure, beams = result
+        coverage = np.zeros((3,) + cube.shape[1:])
+        weights = np.zeros(cube.shape[1:])
+        np.add.at(weights.ravel(), table[1], table[2] / tsys[table[0]]**2)
+        accumulateCoverage(coverage, table, tsys, exposure, specwts=specwts)
+        maps += [makeCoverageMaps(coverage, weights, 5.7e3)[1]]
+    np.testing.assert_allclose(maps[1][inner], 0.5 * maps[0][inner])
+
+
+@pytest.fixture
+def mapFiles(datadir):
+    """
+    Three overlapping raster maps.
+    """
+    files = []
+    for i in range(3):
+        files += [datadir / 'map{0}.fits'.format(i)]
+        makeSdfits(files[-1], seed=i, lat0=0.015 * i, nfeed=2)
+    return(files)
+
+
+def test_parallel(tmp_path, mapFiles):
+    reference = grid(tmp_path, mapFiles, 'serial')
+    cube = grid(tmp_path, mapFiles, 'reproducible', nProc=2,
+                reproducible=True)
+    np.testing.assert_array_equal(cube, reference)
+    cube = grid(tmp_path, mapFiles, 'parallel', nProc=2)
+    assertSameCube(cube, reference)
+
+
+@pytest.mark.parametrize('nProc', [1, 2])
+def test_memory_budget(tmp_path, mapFiles, nProc):
+    # A budget of a few channels forces several slabs
+    reference = grid(tmp_path, mapFiles, 'default')
+    cube = grid(tmp_path, mapFiles, 'slabs', memoryBudget=1e5, nProc=nProc)
+    assertSameCube(cube, reference)
+    np.testing.assert_allclose(
+        fits.getdata(str(tmp_path / 'slabs_wts.fits')),
+        fits.getdata(str(tmp_path / 'default_wts.fits')), rtol=1e-12)
+
+
+def test_tiles(tmp_path, mapFiles):
+    reference = grid(tmp_path, mapFiles, 'default')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        griddata([str(f) for f in mapFiles], outdir=str(tmp_path),
+                 outname='mosaic', tileSize=8, **gridKwargs)
+    with open(str(tmp_path / 'mosaic_tiles.json')) as fh:
+        index = json.load(fh)
+    assert (index['naxis2'], index['naxis1']) == reference.shape[1:]
+    assert len(index['tiles']) > 1
+    covered = np.zeros(reference.shape[1:], dtype=bool)
+    for tile in index['tiles']:
+        cube = fits.getdata(str(tmp_path / tile['file']))
+        # Each tile, overlap included, is the same part of the full cube
+        assertSameCube(cube, reference[:, tile['ymin']:tile['ymax'],
+                                       tile['xmin']:tile['xmax']])
+        covered[tile['ymin']:tile['ymax'], tile['xmin']:tile['xmax']] = True
+    assert np.all(covered | np.isnan(reference[0]))
+
+
+def test_update(tmp_path, mapFiles):
+    # The stored grid of a Galactic cube has no RADESYS or EQUINOX
+    grid(tmp_path, mapFiles[0:2], 'cube', keepCheckpoint=True)
+    header = fits.getheader(str(tmp_path / 'cube.fits'))
+    cube = grid(tmp_path, mapFiles, 'cube', update=True)
+    reference = grid(tmp_path, mapFiles, 'all', templateHeader=header)
+    assertSameCube(cube, reference)
+
+
+@pytest.mark.parametrize('keepCheckpoint', [True, False])
+def test_subtract(tmp_path, mapFiles, keepCheckpoint):
+    # Subtracting cancels most of the weight of the edge pixels.
+    # Without a checkpoint the accumulators are rebuilt from the
+    # float32 cube and weights.
+    rtol = 1e-7 if keepCheckpoint else 1e-5
+    grid(tmp_path, mapFiles, 'cube', keepCheckpoint=keepCheckpoint)
+    header = fits.getheader(str(tmp_path / 'cube.fits'))
+    cube = grid(tmp_path, mapFiles[2:], 'cube', subtract=True)
+    reference = grid(tmp_path, mapFiles[0:2], 'pair', templateHeader=header)
+    assertSameCube(cube, reference, rtol=rtol)
+    weights = fits.getdata(str(tmp_path / 'cube_wts.fits'))
+    np.testing.assert_allclose(
+        weights, fits.getdata(str(tmp_path / 'pair_wts.fits')),
+        rtol=rtol, atol=rtol)
+
+
+def test_split_feeds(tmp_path, datadir, mapFiles):
+    reference = grid(tmp_path, mapFiles, 'default')
+    cube = grid(tmp_path, mapFiles, 'split', splitFeeds='feed')
+    assertSameCube(cube, reference)
+    header = fits.getheader(str(tmp_path / 'split.fits'))
+    weights = fits.getdata(str(tmp_path / 'split_wts.fits'))
+    feedWeights = 0
+    for feed in (0, 1):
+        # The same files with only the rows of this feed
+        feedFiles = []
+        for thisfile in mapFiles:
+            with fits.open(str(thisfile)) as hdulist:
+                table = hdulist[1].data
+                hdu = fits.BinTableHDU(table[table['FDNUM'] == feed])
+            feedFiles += [datadir / 'feed{0}_{1}'.format(feed, thisfile.name)]
+            fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(str(feedFiles[-1]))
+        feedCube = fits.getdata(str(tmp_path
+                                    / 'split_feed{0}.fits'.format(feed)))
+        feedReference = grid(tmp_path, feedFiles, 'only{0}'.format(feed),
+                             templateHeader=header)
+        assertSameCube(feedCube, feedReference)
+        feedWeights = feedWeights + fits.getdata(
+            str(tmp_path / 'split_feed{0}_wts.fits'.format(feed)))
+    np.testing.assert_allclose(feedWeights, weights, rtol=1e-10, atol=1e-15)
+
+
+@pytest.mark.parametrize('options', [{}, {'batch': True}])
+def test_chunked_outliers(tmp_path, datadir, options):
+    # Rows far off the map, spread over several blocks of 25 rows
+    outliers = [5, 63, 101]
+    data = makeSdfits(datadir / 'map.fits', nfeed=2)
+    data['CRVAL2'][outliers] += 0.5
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU(data)]).writeto(
+        str(datadir / 'outliers.fits'))
+    clean = np.delete(np.arange(len(data)), outliers)
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU(data[clean])]).writeto(
+        str(datadir / 'clean.fits'))
+    reference = grid(tmp_path, [datadir / 'outliers.fits'], 'whole',
+                     flagSpatialOutlier=True, **options)
+    cube = grid(tmp_path, [datadir / 'outliers.fits'], 'chunked',
+                flagSpatialOutlier=True, chunkSize=25, **options)
+    assertSameCube(cube, reference)
+    # The outliers are cut and nothing else.  The grid read back from
+    # the header differs from the automatic one by rounding.
+    header = fits.getheader(str(tmp_path / 'whole.fits'))
+    clean = grid(tmp_path, [datadir / 'clean.fits'], 'clean',
+                 templateHeader=header, **options)
+    assertSameCube(cube, clean, rtol=1e-7)
@@ -0,0 +1,22 @@
+import warnings
+import numpy as np
+from astropy.io import fits
+
+from ..QuickLook import quicklook
+from .synthetic import makeSdfits
+
+
+def test_sloped_baseline(tmp_path):
+    # A gentle baseline slope must not fail the default flag tests
+    makeSdfits(tmp_path / 'slope.fits', slope=0.5)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        quicklook([str(tmp_path / 'slope.fits')], outdir=str(tmp_path),
+                  outname='quick')
+    cube = fits.getdata(str(tmp_path / 'quick.fits'))
+    weights = fits.getdata(str(tmp_path / 'quick_wts.fits'))
+    assert np.sum(weights > 0) > 100
+    peak = np.nanmax(cube, axis=(1, 2))
+    assert np.nanmax(peak) > 2.0
+    # The slope is removed: line-free channels are near zero
+    assert np.nanmax(np.abs(np.nanmedian(cube[0:20], axis=(1, 2)))) < 0.1